@@ -0,0 +1,238 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+
+import argparse
+import os
+import time
+from logging import getLogger
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.distributed as dist
+
+from swav.utils import (
+    initialize_exp,
+    fix_random_seeds,
+    init_distributed_mode,
+)
+from swav.kmeans import cluster_sums, kmeans_plus_plus, nearest_centroids
+from swav.checkpoint import atomic_save, mmap_load
+
+logger = getLogger()
+
+parser = argparse.ArgumentParser(description="Distributed k-means over exported embeddings")
+
+#########################
+#### data parameters ####
+#########################
+parser.add_argument("--embeddings", type=str, nargs="+", required=True, help="""files (.npy or .pth)
+                    of L2-normalized embeddings (N x D), clustered as their concatenation in this order""")
+parser.add_argument("--dump_path", type=str, default=".",
+                    help="experiment dump path for the centroids, the assignments and the log")
+
+#########################
+### k-means parameters ##
+#########################
+parser.add_argument("--nmb_clusters", default=3000, type=int, help="number of clusters")
+parser.add_argument("--kmeans_iters", default=20, type=int, help="maximum number of k-means iterations")
+parser.add_argument("--kmeans_tol", default=0.001, type=float, help="""stop k-means once the
+                    fraction of the assignments changed by an iteration is below this (0 to disable)""")
+parser.add_argument("--kmeans_init", default="random", type=str, choices=["random", "kmeans++"],
+                    help="initialization of the centroids")
+parser.add_argument("--init_sample", default=100000, type=int, help="""number of embeddings of every
+                    process the centroids are drawn from with --kmeans_init kmeans++""")
+parser.add_argument("--kmeans_chunk_size", default=65536, type=int, help="""number of embeddings
+                    read from disk and scored against the centroids at once""")
+
+#########################
+#### dist parameters ###
+#########################
+parser.add_argument("--dist_url", default="env://", type=str, help="""url used to set up distributed
+                    training; see https://pytorch.org/docs/stable/distributed.html""")
+parser.add_argument("--world_size", default=-1, type=int, help="""
+                    number of processes: it is set automatically and
+                    should not be passed as argument""")
+parser.add_argument("--rank", default=0, type=int, help="""rank of this process:
+                    it is set automatically and should not be passed as argument""")
+parser.add_argument("--local_rank", default=0, type=int,
+                    help="this argument is not used and should be ignored")
+
+#########################
+#### other parameters ###
+#########################
+parser.add_argument("--threads", default=0, type=int,
+                    help="number of threads of every process (0 for the torch default)")
+parser.add_argument("--seed", type=int, default=31, help="seed")
+
+
+def main():
+    global args
+    args = parser.parse_args()
+    init_distributed_mode(args, backend="gloo")
+    fix_random_seeds(args.seed)
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    logger, stats = initialize_exp(args, "iteration", "objective", "changed")
+
+    # every process clusters a contiguous part of the embeddings
+    segments, start, size_dataset = local_segments(args.embeddings, args.rank, args.world_size)
+    size_local = sum(len(s) for s in segments)
+    logger.info("Clustering embeddings {} to {} of {}.".format(start, start + size_local, size_dataset))
+
+    centroids, assignments, scores = cluster(segments, size_dataset, stats)
+
+    # save the centroids and the assignments of all the embeddings
+    if args.rank == 0:
+        atomic_save(centroids, os.path.join(args.dump_path, "centroids.pth"))
+    write_rows(os.path.join(args.dump_path, "assignments.npy"), assignments, start, size_dataset)
+    write_rows(os.path.join(args.dump_path, "scores.npy"), scores, start, size_dataset)
+    logger.info("Centroids, assignments and scores saved in {}".format(args.dump_path))
+
+
+def open_embeddings(path):
+    """memory-mapped embeddings (N x D) of a .npy or .pth file"""
+    if path.endswith(".npy"):
+        # copy-on-write, so that torch gets a writable array without reading it
+        return torch.from_numpy(np.load(path, mmap_mode="c"))
+    return mmap_load(path)
+
+
+def local_segments(paths, rank, world_size):
+    """
+    Parts of the embedding files held by this process: the rows
+    [N * rank / world_size, N * (rank + 1) / world_size) of their concatenation.
+    Return them, their first row and the total number of rows N.
+    """
+    files = [open_embeddings(path) for path in paths]
+    size_dataset = sum(len(f) for f in files)
+    assert size_dataset >= world_size, "fewer embeddings than processes"
+    start, end = size_dataset * rank // world_size, size_dataset * (rank + 1) // world_size
+    segments, offset = [], 0
+    for f in files:
+        low, high = max(start, offset), min(end, offset + len(f))
+        if low < high:
+            segments.append(f[low - offset: high - offset])
+        offset += len(f)
+    return segments, start, size_dataset
+
+
+def sample_rows(segments, n, generator):
+    """`n` random embeddings of this process, in fp32"""
+    size_local = sum(len(s) for s in segments)
+    idx = torch.randperm(size_local, generator=generator)[:n].sort().values
+    rows, offset = [], 0
+    for segment in segments:
+        selected = idx[(idx >= offset) & (idx < offset + len(segment))] - offset
+        rows.append(segment[selected].float())
+        offset += len(segment)
+    return torch.cat(rows)
+
+
+def e_step(segments, centroids):
+    assignments, scores = zip(*[
+        nearest_centroids(segment, centroids, args.kmeans_chunk_size, return_scores=True) for segment in segments
+    ])
+    return torch.cat(assignments), torch.cat(scores)
+
+
+def m_step(segments, assignments):
+    emb_sums, counts, start = 0, 0, 0
+    for segment in segments:
+        sums, cnts = cluster_sums(
+            segment, assignments[start: start + len(segment)], args.nmb_clusters, args.kmeans_chunk_size,
+        )
+        emb_sums, counts = emb_sums + sums, counts + cnts
+        start += len(segment)
+    return emb_sums, counts
+
+
+def cluster(segments, size_dataset, stats):
+    """
+    Distributed spherical k-means over the embeddings of all the processes,
+    with the structure of the clustering of DeepCluster-v2.
+    Return the centroids, and the assignments and scores (cosine similarity
+    with their centroid) of the local embeddings.
+    """
+    K = args.nmb_clusters
+    generator = torch.Generator().manual_seed(args.seed + args.rank)
+    with torch.no_grad():
+        start_time = time.time()
+        if args.kmeans_init == "kmeans++":
+            sample = sample_rows(segments, args.init_sample, generator)
+            centroids = kmeans_plus_plus(sample, K, seed=args.seed, chunk_size=args.kmeans_chunk_size)
+        else:
+            # init centroids with embeddings of rank 0
+            centroids = torch.empty(K, segments[0].size(1))
+            if args.rank == 0:
+                centroids = sample_rows(segments, K, generator)
+                assert len(centroids) >= K, "please reduce the number of centroids"
+            dist.broadcast(centroids, 0)
+        logger.info("Initialization of the centroids done in {:.1f}s".format(time.time() - start_time))
+
+        changed = 1.
+        for n_iter in range(args.kmeans_iters + 1):
+            start_time = time.time()
+
+            # E step
+            assignments, scores = e_step(segments, centroids)
+            objective = scores.sum().double()
+            dist.all_reduce(objective)
+            objective = objective.item() / size_dataset
+
+            # finish
+            if n_iter == args.kmeans_iters:
+                break
+
+            # stop once the assignments are stable
+            if n_iter > 0 and args.kmeans_tol > 0:
+                changed = (assignments != previous_assignments).sum()
+                dist.all_reduce(changed)
+                changed = changed.item() / size_dataset
+                if changed < args.kmeans_tol:
+                    break
+            previous_assignments = assignments
+
+            # M step
+            emb_sums, counts = m_step(segments, assignments)
+            dist.all_reduce(counts)
+            dist.all_reduce(emb_sums)
+            mask = counts > 0
+            centroids[mask] = emb_sums[mask] / counts[mask].unsqueeze(1)
+
+            # normalize centroids
+            centroids = nn.functional.normalize(centroids, dim=1, p=2)
+
+            stats.update((n_iter, objective, changed))
+            logger.info("Iteration {}: average cosine similarity {:.4f}, {:.4f} of the assignments changed, "
+                        "{} empty clusters, {:.1f}s".format(
+                            n_iter, objective, changed, (~mask).sum().item(), time.time() - start_time))
+
+        stats.update((n_iter, objective, changed))
+        logger.info("k-means with {} centroids done after {} iterations, average cosine similarity {:.4f}".format(
+            K, n_iter, objective))
+    return centroids, assignments, scores
+
+
+def write_rows(path, values, start, size_dataset):
+    """
+    Write the rows [start, start + len(values)) of the .npy file `path`
+    of `size_dataset` rows shared by all the processes.
+    """
+    values = values.numpy()
+    if args.rank == 0:
+        np.lib.format.open_memmap(path, mode="w+", dtype=values.dtype, shape=(size_dataset,)).flush()
+    dist.barrier()
+    rows = np.lib.format.open_memmap(path, mode="r+")
+    rows[start: start + len(values)] = values
+    rows.flush()
+    del rows
+    dist.barrier()
+
+
+if __name__ == "__main__":
+    main()
@@ -27,9 +27,12 @@ from swav.utils import (
     restart_from_checkpoint,
     fix_random_seeds,
     AverageMeter,
+    DeviceMeter,
     init_distributed_mode,
     accuracy,
 )
+from swav.mixed_precision import MixedPrecision, PRECISIONS
+from swav.checkpoint import load_checkpoint, CHECKPOINT_READS
 import swav.resnet50 as resnet_models
 
 logger = getLogger()
@@ -49,6 +52,8 @@ parser.add_argument("--data_path", type=str, default="/path/to/imagenet",
                     help="path to imagenet")
 parser.add_argument("--workers", default=10, type=int,
                     help="number of data loading workers")
+parser.add_argument("--precision", type=str, default="fp32", choices=list(PRECISIONS),
+                    help="train in full precision (fp32) or with fp16 / bf16 mixed precision")
 
 #########################
 #### model parameters ###
@@ -81,6 +86,12 @@ parser.add_argument("--rank", default=0, type=int, help="""rank of this process:
                     it is set automatically and should not be passed as argument""")
 parser.add_argument("--local_rank", default=0, type=int,
                     help="this argument is not used and should be ignored")
+parser.add_argument("--dist_backend", default="auto", type=str, choices=["auto", "nccl", "gloo"],
+                    help="""nccl to run on GPUs or gloo to run on CPUs, auto selects nccl if GPUs
+                    are available""")
+parser.add_argument("--checkpoint_read", type=str, default="single", choices=CHECKPOINT_READS,
+                    help="""processes reading the checkpoints when resuming: all of them, the first
+                    one of every node or a single one, broadcasting to the others""")
 
 
 def main():
@@ -124,25 +135,30 @@ def main():
         sampler=sampler,
         batch_size=args.batch_size,
         num_workers=args.workers,
-        pin_memory=True,
+        pin_memory=args.device.type == "cuda",
     )
     val_loader = torch.utils.data.DataLoader(
         val_dataset,
         batch_size=args.batch_size,
         num_workers=args.workers,
-        pin_memory=True,
+        pin_memory=args.device.type == "cuda",
     )
     logger.info("Building data done with {} images loaded.".format(len(train_dataset)))
 
     # build model
     model = resnet_models.__dict__[args.arch](output_dim=1000)
 
-    # convert batch norm layers
-    model = nn.SyncBatchNorm.convert_sync_batchnorm(model)
+    # convert batch norm layers (SyncBatchNorm only runs on GPU)
+    if args.device.type == "cuda":
+        model = nn.SyncBatchNorm.convert_sync_batchnorm(model)
 
     # load weights
     if os.path.isfile(args.pretrained):
-        state_dict = torch.load(args.pretrained, map_location="cuda:" + str(args.gpu_to_work_on))
+        state_dict = load_checkpoint(
+            args.pretrained,
+            map_location=args.device,
+            read=args.checkpoint_read,
+        )
         if "state_dict" in state_dict:
             state_dict = state_dict["state_dict"]
         # remove prefixe "module."
@@ -158,11 +174,11 @@ def main():
     else:
         logger.info("No pretrained weights found => training from random weights")
 
-    # model to gpu
-    model = model.cuda()
+    # model to the device
+    model = model.to(args.device)
     model = nn.parallel.DistributedDataParallel(
         model,
-        device_ids=[args.gpu_to_work_on],
+        device_ids=None if args.gpu_to_work_on is None else [args.gpu_to_work_on],
         find_unused_parameters=True,
     )
 
@@ -186,14 +202,19 @@ def main():
         optimizer, args.decay_epochs, gamma=args.gamma
     )
 
+    # init mixed precision
+    mixed_precision = MixedPrecision(args.precision, device_type=args.device.type)
+
     # Optionally resume from a checkpoint
     to_restore = {"epoch": 0, "best_acc": (0., 0.)}
     restart_from_checkpoint(
         os.path.join(args.dump_path, "checkpoint.pth.tar"),
         run_variables=to_restore,
+        read=args.checkpoint_read,
         state_dict=model,
         optimizer=optimizer,
         scheduler=scheduler,
+        scaler=mixed_precision,
     )
     start_epoch = to_restore["epoch"]
     best_acc = to_restore["best_acc"]
@@ -207,9 +228,9 @@ def main():
         # set samplers
         train_loader.sampler.set_epoch(epoch)
 
-        scores = train(model, optimizer, train_loader, epoch)
-        scores_val = validate_network(val_loader, model)
-        training_stats.update(scores + scores_val)
+        scores = train(model, optimizer, mixed_precision, train_loader, epoch)
+        scores_val = validate_network(val_loader, model, mixed_precision)
+        training_stats.update(scores + scores_val, save=True)
 
         scheduler.step()
 
@@ -222,13 +243,15 @@ def main():
                 "scheduler": scheduler.state_dict(),
                 "best_acc": best_acc,
             }
+            if mixed_precision.enabled:
+                save_dict["scaler"] = mixed_precision.state_dict()
             torch.save(save_dict, os.path.join(args.dump_path, "checkpoint.pth.tar"))
     logger.info("Fine-tuning with {}% of labels completed.\n"
                 "Test accuracies: top-1 {acc1:.1f}, top-5 {acc5:.1f}".format(
                 args.labels_perc, acc1=best_acc[0], acc5=best_acc[1]))
 
 
-def train(model, optimizer, loader, epoch):
+def train(model, optimizer, mixed_precision, loader, epoch):
     """
     Train the models on the dataset.
     """
@@ -237,38 +260,40 @@ def train(model, optimizer, loader, epoch):
     data_time = AverageMeter()
 
     # training statistics
-    top1 = AverageMeter()
-    top5 = AverageMeter()
-    losses = AverageMeter()
+    top1 = DeviceMeter()
+    top5 = DeviceMeter()
+    losses = DeviceMeter()
     end = time.perf_counter()
 
     model.train()
-    criterion = nn.CrossEntropyLoss().cuda()
+    criterion = nn.CrossEntropyLoss().to(args.device)
 
     for iter_epoch, (inp, target) in enumerate(loader):
         # measure data loading time
         data_time.update(time.perf_counter() - end)
 
         # move to gpu
-        inp = inp.cuda(non_blocking=True)
-        target = target.cuda(non_blocking=True)
+        inp = inp.to(args.device, non_blocking=True)
+        target = target.to(args.device, non_blocking=True)
 
         # forward
-        output = model(inp)
+        with mixed_precision.autocast():
+            output = model(inp)
 
         # compute cross entropy loss
+        output = output.float()
         loss = criterion(output, target)
 
         # compute the gradients
         optimizer.zero_grad()
-        loss.backward()
+        mixed_precision.backward(loss)
 
         # step
-        optimizer.step()
+        mixed_precision.step(optimizer)
 
         # update stats
         acc1, acc5 = accuracy(output, target, topk=(1, 5))
-        losses.update(loss.item(), inp.size(0))
+        losses.update(loss, inp.size(0))
         top1.update(acc1[0], inp.size(0))
         top5.update(acc5[0], inp.size(0))
 
@@ -296,35 +321,40 @@ def train(model, optimizer, loader, epoch):
                     lr_W=optimizer.param_groups[1]["lr"],
                 )
             )
-    return epoch, losses.avg, top1.avg.item(), top5.avg.item()
+    # average over all the processes
+    for meter in (losses, top1, top5):
+        meter.all_reduce()
+    return epoch, losses.avg, top1.avg, top5.avg
 
 
-def validate_network(val_loader, model):
+def validate_network(val_loader, model, mixed_precision):
     batch_time = AverageMeter()
-    losses = AverageMeter()
-    top1 = AverageMeter()
-    top5 = AverageMeter()
+    losses = DeviceMeter()
+    top1 = DeviceMeter()
+    top5 = DeviceMeter()
     global best_acc
 
     # switch to evaluate mode
     model.eval()
 
-    criterion = nn.CrossEntropyLoss().cuda()
+    criterion = nn.CrossEntropyLoss().to(args.device)
 
     with torch.no_grad():
         end = time.perf_counter()
         for i, (inp, target) in enumerate(val_loader):
 
             # move to gpu
-            inp = inp.cuda(non_blocking=True)
-            target = target.cuda(non_blocking=True)
+            inp = inp.to(args.device, non_blocking=True)
+            target = target.to(args.device, non_blocking=True)
 
             # compute output
-            output = model(inp)
+            with mixed_precision.autocast():
+                output = model(inp)
+            output = output.float()
             loss = criterion(output, target)
 
             acc1, acc5 = accuracy(output, target, topk=(1, 5))
-            losses.update(loss.item(), inp.size(0))
+            losses.update(loss, inp.size(0))
             top1.update(acc1[0], inp.size(0))
             top5.update(acc5[0], inp.size(0))
 
@@ -332,8 +362,8 @@ def validate_network(val_loader, model):
             batch_time.update(time.perf_counter() - end)
             end = time.perf_counter()
 
-    if top1.avg.item() > best_acc[0]:
-        best_acc = (top1.avg.item(), top5.avg.item())
+    if top1.avg > best_acc[0]:
+        best_acc = (top1.avg, top5.avg)
 
     if args.rank == 0:
         logger.info(
@@ -344,7 +374,7 @@ def validate_network(val_loader, model):
             "Best Acc@1 so far {acc:.1f}".format(
                 batch_time=batch_time, loss=losses, top1=top1, acc=best_acc[0]))
 
-    return losses.avg, top1.avg.item(), top5.avg.item()
+    return losses.avg, top1.avg, top5.avg
 
 
 if __name__ == "__main__":
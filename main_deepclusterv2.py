@@ -8,7 +8,6 @@
 import argparse
 import math
 import os
-import shutil
 import time
 from logging import getLogger
 
@@ -19,9 +18,7 @@ import torch.nn.parallel
 import torch.backends.cudnn as cudnn
 import torch.distributed as dist
 import torch.optim
-import apex
-from apex.parallel.LARC import LARC
-from scipy.sparse import csr_matrix
+from torch.utils.tensorboard import SummaryWriter
 
 from swav.utils import (
     bool_flag,
@@ -29,8 +26,18 @@ from swav.utils import (
     restart_from_checkpoint,
     fix_random_seeds,
     AverageMeter,
+    DeviceMeter,
+    BackgroundTask,
     init_distributed_mode,
 )
+from swav.mixed_precision import MixedPrecision, PRECISIONS
+from swav.optim import LARC, build_optimizer, consolidate_state_dict
+from swav.distributed import CommHook, COMM_HOOKS, all_reduce_, broadcast_
+from swav.profiler import StepTimer, StragglerMonitor, parse_steps, timed
+from swav.kmeans import cluster_sums, kmeans_plus_plus, nearest_centroids
+from swav.checkpoint import CheckpointWriter, CHECKPOINT_READS, load_rows, saved_shards, shard_paths
+from swav.sinkhorn import distributed_sinkhorn
+from swav.memory_bank import AssignmentTable, MEMORY_DTYPES, MEMORY_LOCATIONS, empty_memory, snapshot_memory
 from swav.multicropdataset import MultiCropDataset
 import swav.resnet50 as resnet_models
 
@@ -63,6 +70,43 @@ parser.add_argument("--feat_dim", default=128, type=int,
                     help="feature dimension")
 parser.add_argument("--nmb_prototypes", default=[3000, 3000, 3000], type=int, nargs="+",
                     help="number of prototypes - it can be multihead")
+parser.add_argument("--epsilon", default=0.05, type=float, help="""regularization parameter of the
+                    Sinkhorn-Knopp codes of the warm-up epoch of --memory_init lazy""")
+parser.add_argument("--sinkhorn_iterations", default=3, type=int, help="""number of iterations of the
+                    Sinkhorn-Knopp codes of the warm-up epoch of --memory_init lazy""")
+parser.add_argument("--kmeans_iters", default=10, type=int,
+                    help="maximum number of k-means iterations per head and per epoch")
+parser.add_argument("--kmeans_tol", default=0.001, type=float, help="""stop k-means once the
+                    fraction of the assignments changed by an iteration is below this (0 to disable)""")
+parser.add_argument("--kmeans_warm_start", default=True, type=bool_flag, help="""start k-means from
+                    the prototypes of the previous epoch""")
+parser.add_argument("--kmeans_init", default="random", type=str, choices=["random", "kmeans++"],
+                    help="initialization of the centroids when not warm-started")
+parser.add_argument("--async_clustering", default=False, type=bool_flag, help="""cluster the memory
+                    banks in the background during the next epoch, which trains with the assignments
+                    of the previous clustering (one epoch staler)""")
+parser.add_argument("--kmeans_chunk_size", default=8192, type=int, help="""number of embeddings
+                    scored against the centroids at once in k-means (0 for the whole memory bank)""")
+parser.add_argument("--shard_assignments", default=False, type=bool_flag, help="""keep on every process
+                    only the assignments of the samples it trains on during the epoch, instead of the
+                    assignments of the whole dataset""")
+parser.add_argument("--memory_dtype", default="fp32", type=str, choices=list(MEMORY_DTYPES),
+                    help="precision of the embeddings stored in the memory banks, k-means runs in fp32")
+parser.add_argument("--memory_location", default="gpu", type=str, choices=MEMORY_LOCATIONS, help="""keep the
+                    memory banks on the GPU, in pinned host memory (cpu) or in a memory-mapped file (mmap),
+                    k-means transfers them to the GPU by chunks of --kmeans_chunk_size""")
+parser.add_argument("--memory_dir", default="", type=str, help="""directory of the memory-mapped
+                    memory banks with --memory_location mmap, preferably on a local disk (dump path if empty)""")
+parser.add_argument("--memory_init", default="full", type=str, choices=["full", "subset", "file", "lazy"],
+                    help="""initialization of the memory banks before the first clustering: a pass over the
+                    whole dataset (full), over a random --memory_init_fraction of it (subset), the memory banks
+                    saved in --memory_init_path (file), or during a first warm-up epoch trained with the
+                    Sinkhorn-Knopp codes of the prototypes instead of the k-means assignments (lazy)""")
+parser.add_argument("--memory_init_fraction", default=0.1, type=float,
+                    help="fraction of the dataset embedded to initialize the memory banks with --memory_init subset")
+parser.add_argument("--memory_init_path", default="", type=str, help="""dump path of a previous run whose
+                    memory banks (mb{rank}.pth, saved by any number of processes) initialize the ones of
+                    this run with --memory_init file""")
 
 #########################
 #### optim parameters ###
@@ -79,6 +123,8 @@ parser.add_argument("--wd", default=1e-6, type=float, help="weight decay")
 parser.add_argument("--warmup_epochs", default=10, type=int, help="number of warmup epochs")
 parser.add_argument("--start_warmup", default=0, type=float,
                     help="initial warmup learning rate")
+parser.add_argument("--zero_optimizer", type=bool_flag, default=False,
+                    help="partition the optimizer state across the processes (ZeRO)")
 
 #########################
 #### dist parameters ###
@@ -92,6 +138,18 @@ parser.add_argument("--rank", default=0, type=int, help="""rank of this process:
                     it is set automatically and should not be passed as argument""")
 parser.add_argument("--local_rank", default=0, type=int,
                     help="this argument is not used and should be ignored")
+parser.add_argument("--dist_backend", default="auto", type=str, choices=["auto", "nccl", "gloo"],
+                    help="""nccl to run on GPUs or gloo to run on CPUs, auto selects nccl if GPUs
+                    are available""")
+parser.add_argument("--checkpoint_read", type=str, default="single", choices=CHECKPOINT_READS,
+                    help="""processes reading the checkpoints when resuming: all of them, the first
+                    one of every node or a single one, broadcasting to the others""")
+parser.add_argument("--comm_hook", type=str, default="none", choices=COMM_HOOKS,
+                    help="compression of the gradients all-reduced by DDP")
+parser.add_argument("--powersgd_rank", type=int, default=1,
+                    help="rank of the low-rank approximation of the gradients with --comm_hook powersgd")
+parser.add_argument("--powersgd_start_iter", type=int, default=1000,
+                    help="all-reduce the full gradients during this many iterations with --comm_hook powersgd")
 
 #########################
 #### other parameters ###
@@ -103,19 +161,45 @@ parser.add_argument("--workers", default=10, type=int,
                     help="number of data loading workers")
 parser.add_argument("--checkpoint_freq", type=int, default=25,
                     help="Save the model periodically")
+parser.add_argument("--precision", type=str, default="fp32", choices=list(PRECISIONS),
+                    help="train in full precision (fp32) or with fp16 / bf16 mixed precision")
 parser.add_argument("--sync_bn", type=str, default="pytorch", help="synchronize bn")
 parser.add_argument("--dump_path", type=str, default=".",
                     help="experiment dump path for checkpoints and log")
 parser.add_argument("--seed", type=int, default=31, help="seed")
+parser.add_argument("--step_timing", type=bool_flag, default=False, help="""time the phases of
+                    the training step and of the clustering, logged per epoch, in timing{rank}.csv
+                    and in TensorBoard""")
+parser.add_argument("--profile_steps", type=str, default="", help="""run the torch profiler
+                    between these iterations (start:end) and export its Chrome trace""")
+parser.add_argument("--straggler_freq", type=int, default=100, help="""compare the step and data
+                    times of the processes every this many iterations to detect the stragglers (0 to disable)""")
 
 
 def main():
     global args
+    start_time = time.time()
     args = parser.parse_args()
     init_distributed_mode(args)
     fix_random_seeds(args.seed)
     logger, training_stats = initialize_exp(args, "epoch", "loss")
 
+    # instrumentation of the training step and of the clustering
+    timer = StepTimer(
+        enabled=args.step_timing,
+        csv_path=os.path.join(args.dump_path, "timing" + str(args.rank) + ".csv"),
+        tb_writer=SummaryWriter() if args.step_timing and args.rank == 0 else None,
+        profile_steps=parse_steps(args.profile_steps),
+        trace_dir=args.dump_path,
+        rank=args.rank,
+        device=args.device,
+    ).activate()
+    straggler_monitor = StragglerMonitor(
+        args.straggler_freq,
+        stats_path=os.path.join(args.dump_path, "stragglers.jsonl"),
+        rank=args.rank,
+    )
+
     # build data
     train_dataset = MultiCropDataset(
         args.data_path,
@@ -131,7 +215,7 @@ def main():
         sampler=sampler,
         batch_size=args.batch_size,
         num_workers=args.workers,
-        pin_memory=True,
+        pin_memory=args.device.type == "cuda",
         drop_last=True
     )
     logger.info("Building data done with {} images loaded.".format(len(train_dataset)))
@@ -142,24 +226,28 @@ def main():
         hidden_mlp=args.hidden_mlp,
         output_dim=args.feat_dim,
         nmb_prototypes=args.nmb_prototypes,
+        freeze_prototypes_niters=args.freeze_prototypes_niters,
     )
-    # synchronize batch norm layers
-    if args.sync_bn == "pytorch":
+    # synchronize batch norm layers (SyncBatchNorm only runs on GPU)
+    if args.sync_bn == "pytorch" and args.device.type == "cuda":
         model = nn.SyncBatchNorm.convert_sync_batchnorm(model)
-    elif args.sync_bn == "apex":
+    elif args.sync_bn == "apex" and args.device.type == "cuda":
+        import apex
         process_group = None
         if args.world_size // 8 > 0:
             process_group = apex.parallel.create_syncbn_process_group(args.world_size // 8)
         model = apex.parallel.convert_syncbn_model(model, process_group=process_group)
-    # copy model to GPU
-    model = model.cuda()
+    # copy model to the device
+    model = model.to(args.device)
     if args.rank == 0:
         logger.info(model)
     logger.info("Building model done.")
 
     # build optimizer
-    optimizer = torch.optim.SGD(
+    optimizer = build_optimizer(
+        torch.optim.SGD,
         model.parameters(),
+        zero=args.zero_optimizer,
         lr=args.base_lr,
         momentum=0.9,
         weight_decay=args.wd,
@@ -172,31 +260,59 @@ def main():
     lr_schedule = np.concatenate((warmup_lr_schedule, cosine_lr_schedule))
     logger.info("Building optimizer done.")
 
+    # init mixed precision
+    mixed_precision = MixedPrecision(args.precision, device_type=args.device.type)
+    logger.info("Initializing {} precision done.".format(args.precision))
+
     # wrap model
     model = nn.parallel.DistributedDataParallel(
         model,
-        device_ids=[args.gpu_to_work_on],
+        device_ids=None if args.gpu_to_work_on is None else [args.gpu_to_work_on],
         find_unused_parameters=True,
     )
+    comm_hook = CommHook(model, args.comm_hook, args.powersgd_rank, args.powersgd_start_iter, timer=timer)
+    logger.info("Using communication hook: {}".format(comm_hook))
 
     # optionally resume from a checkpoint
-    to_restore = {"epoch": 0}
+    to_restore = {"epoch": 0, "world_size": args.world_size}
     restart_from_checkpoint(
         os.path.join(args.dump_path, "checkpoint.pth.tar"),
         run_variables=to_restore,
+        read=args.checkpoint_read,
         state_dict=model,
         optimizer=optimizer,
+        scaler=mixed_precision,
+        comm_hook=comm_hook,
     )
     start_epoch = to_restore["epoch"]
 
     # build the memory bank
     mb_path = os.path.join(args.dump_path, "mb" + str(args.rank) + ".pth")
-    if os.path.isfile(mb_path):
-        mb_ckp = torch.load(mb_path)
-        local_memory_index = mb_ckp["local_memory_index"]
-        local_memory_embeddings = mb_ckp["local_memory_embeddings"]
+    prev_paths = shard_paths(args.dump_path, "mb", to_restore["world_size"])
+    lazy_epoch = -1
+    if all(os.path.isfile(p) for p in prev_paths):
+        local_memory_index, local_memory_embeddings = load_memory(prev_paths, len(train_loader))
+    elif args.memory_init == "file":
+        init_paths = saved_shards(args.memory_init_path, "mb")
+        assert len(init_paths) > 0, "no memory bank found in {}".format(args.memory_init_path)
+        local_memory_index, local_memory_embeddings = load_memory(init_paths, len(train_loader))
+        logger.info("Memory banks initialized from the {} files of {}".format(len(init_paths), args.memory_init_path))
+    elif args.memory_init == "lazy":
+        # filled by the first epoch
+        local_memory_index = torch.zeros(len(train_loader) * args.batch_size, dtype=torch.long, device=args.device)
+        local_memory_embeddings = build_memory(len(train_loader) * args.batch_size)
+        lazy_epoch = start_epoch
     else:
-        local_memory_index, local_memory_embeddings = init_memory(train_loader, model)
+        fraction = args.memory_init_fraction if args.memory_init == "subset" else 1.
+        local_memory_index, local_memory_embeddings = init_memory(train_loader, model, mixed_precision, fraction)
+
+    # checkpoints are written in the background
+    checkpoint_writer = CheckpointWriter()
+
+    # background clustering uses its own communicator, on the host so that its collectives
+    # never run on the GPU concurrently with (and in another order than) the ones of DDP
+    clustering_group = dist.new_group(backend="gloo") if args.async_clustering else None
+    local_assignments, clustering = None, None
 
     cudnn.benchmark = True
     for epoch in range(start_epoch, args.epochs):
@@ -207,53 +323,125 @@ def main():
         # set sampler
         train_loader.sampler.set_epoch(epoch)
 
+        if epoch == lazy_epoch:
+            # the memory banks are filled during this epoch, trained without the k-means assignments
+            assignments = None
+            logger.info("Warm-up epoch {} filling the memory banks.".format(epoch))
+        else:
+            # cluster the memory banks, from the prototypes of the previous epoch
+            # unless it filled them lazily
+            warm_start = args.kmeans_warm_start and epoch > 0 and epoch - 1 != lazy_epoch
+            if local_assignments is None or not args.async_clustering:
+                clustered_index = local_memory_index.clone()
+                local_assignments, centroids = cluster_memory(
+                    model.module.prototypes.head_weights(),
+                    local_memory_embeddings,
+                    nmb_kmeans_iters=args.kmeans_iters,
+                    warm_start=warm_start,
+                )
+                set_prototypes(model, centroids)
+            else:
+                # swap in the clustering which ran during the previous epoch
+                local_assignments, centroids = clustering.result()
+                clustered_index = snapshot_index
+                set_prototypes(model, centroids)
+            if args.async_clustering and epoch < args.epochs - 1:
+                # and cluster a snapshot of the memory banks during this one, from its prototypes
+                snapshot_index = local_memory_index.clone()
+                clustering = BackgroundTask(
+                    cluster_memory,
+                    [w.clone() for w in model.module.prototypes.head_weights()],
+                    snapshot_memory(local_memory_embeddings, args.memory_location, memory_path("clustering")),
+                    nmb_kmeans_iters=args.kmeans_iters,
+                    warm_start=args.kmeans_warm_start,
+                    group=clustering_group,
+                    abort_group=clustering_group,
+                )
+            with timed("assignments_gather"):
+                sampler_indices = None
+                if args.shard_assignments:
+                    # the samples of this epoch, in the order of the loader
+                    sampler_indices = list(iter(train_loader.sampler))[:len(train_loader) * args.batch_size]
+                assignments = AssignmentTable(
+                    clustered_index,
+                    local_assignments,
+                    len(train_loader.dataset),
+                    args.nmb_prototypes,
+                    sampler_indices=sampler_indices,
+                )
+            timer.phase(epoch * len(train_loader))
+            logger.info('Clustering for epoch {} done.'.format(epoch))
+
         # train the network
         scores, local_memory_index, local_memory_embeddings = train(
             train_loader,
             model,
             optimizer,
+            mixed_precision,
             epoch,
             lr_schedule,
+            assignments,
             local_memory_index,
             local_memory_embeddings,
+            timer,
+            straggler_monitor,
+            start_time=start_time if epoch == start_epoch else None,
         )
-        training_stats.update(scores)
+        training_stats.update(scores, save=True)
 
         # save checkpoints
+        consolidate_state_dict(optimizer)
         if args.rank == 0:
             save_dict = {
                 "epoch": epoch + 1,
                 "state_dict": model.state_dict(),
                 "optimizer": optimizer.state_dict(),
+                "comm_hook": comm_hook.state_dict(),
+                "world_size": args.world_size,
             }
-            torch.save(
+            if mixed_precision.enabled:
+                save_dict["scaler"] = mixed_precision.state_dict()
+            copies = []
+            if epoch % args.checkpoint_freq == 0 or epoch == args.epochs - 1:
+                copies.append(os.path.join(args.dump_checkpoints, "ckp-" + str(epoch) + ".pth"))
+            checkpoint_writer.save(
                 save_dict,
                 os.path.join(args.dump_path, "checkpoint.pth.tar"),
+                copies=copies,
             )
-            if epoch % args.checkpoint_freq == 0 or epoch == args.epochs - 1:
-                shutil.copyfile(
-                    os.path.join(args.dump_path, "checkpoint.pth.tar"),
-                    os.path.join(args.dump_checkpoints, "ckp-" + str(epoch) + ".pth"),
-                )
-        torch.save({"local_memory_embeddings": local_memory_embeddings,
-                    "local_memory_index": local_memory_index}, mb_path)
-
-
-def train(loader, model, optimizer, epoch, schedule, local_memory_index, local_memory_embeddings):
+        if args.memory_location == "mmap":
+            # written from a memory-mapped copy instead of a copy in RAM, once
+            # the previous checkpoint, written from the same file, is done
+            checkpoint_writer.wait()
+            checkpoint_writer.save({
+                "local_memory_embeddings": snapshot_memory(
+                    local_memory_embeddings, args.memory_location, memory_path("checkpoint")),
+                "local_memory_index": local_memory_index.to("cpu", copy=True),
+            }, mb_path, copy=False)
+        else:
+            checkpoint_writer.save({"local_memory_embeddings": local_memory_embeddings,
+                                    "local_memory_index": local_memory_index}, mb_path)
+    checkpoint_writer.wait()
+
+
+def train(loader, model, optimizer, mixed_precision, epoch, schedule, assignments, local_memory_index,
+          local_memory_embeddings, timer=None, straggler_monitor=None, start_time=None):
     batch_time = AverageMeter()
     data_time = AverageMeter()
-    losses = AverageMeter()
+    losses = DeviceMeter()
+    timer = timer or StepTimer()
+    straggler_monitor = straggler_monitor or StragglerMonitor(0)
     model.train()
-    cross_entropy = nn.CrossEntropyLoss(ignore_index=-100)
-
-    assignments = cluster_memory(model, local_memory_index, local_memory_embeddings, len(loader.dataset))
-    logger.info('Clustering for epoch {} done.'.format(epoch))
+    # summed, then averaged over the samples with an assignment, since a batch can have none
+    # (e.g. in the first epoch of --memory_init subset) and its mean would be NaN
+    cross_entropy = nn.CrossEntropyLoss(ignore_index=-100, reduction="sum")
 
     end = time.time()
     start_idx = 0
     for it, (idx, inputs) in enumerate(loader):
         # measure data loading time
         data_time.update(time.time() - end)
+        timer.add("data", data_time.val)
 
         # update learning rate
         iteration = epoch * len(loader) + it
@@ -261,38 +449,52 @@ def train(loader, model, optimizer, epoch, schedule, local_memory_index, local_m
             param_group["lr"] = schedule[iteration]
 
         # ============ multi-res forward passes ... ============
-        emb, output = model(inputs)
-        emb = emb.detach()
+        with mixed_precision.autocast():
+            emb, output = model(inputs)
+        # the loss is computed in fp32
+        emb = emb.detach().float()
+        output = [out.float() for out in output]
         bs = inputs[0].size(0)
 
         # ============ deepcluster-v2 loss ... ============
-        loss = 0
-        for h in range(len(args.nmb_prototypes)):
-            scores = output[h] / args.temperature
-            targets = assignments[h][idx].repeat(sum(args.nmb_crops)).cuda(non_blocking=True)
-            loss += cross_entropy(scores, targets)
-        loss /= len(args.nmb_prototypes)
+        with timed("loss"):
+            if assignments is None:
+                loss = warmup_loss(output, bs)
+                nmb_assigned = bs
+            else:
+                loss = 0
+                targets = assignments.targets(idx, start_idx)
+                # the same samples have an assignment in every head
+                nmb_assigned = (targets[0] != -100).sum()
+                for h in range(len(args.nmb_prototypes)):
+                    scores = output[h] / args.temperature
+                    loss += cross_entropy(scores, targets[h].repeat(sum(args.nmb_crops)))
+                loss /= len(args.nmb_prototypes) * sum(args.nmb_crops) * nmb_assigned.clamp_min(1)
 
         # ============ backward and optim step ... ============
         optimizer.zero_grad()
-        loss.backward()
-        # cancel some gradients
-        if iteration < args.freeze_prototypes_niters:
-            for name, p in model.named_parameters():
-                if "prototypes" in name:
-                    p.grad = None
-        optimizer.step()
+        with timed("backward"):
+            mixed_precision.backward(loss)
+        with timed("optimizer"):
+            # cancel some gradients
+            model.module.prototypes.cancel_gradients(iteration)
+            mixed_precision.step(optimizer)
+        losses.update(loss, nmb_assigned)
+        if start_time is not None and it == 0:
+            logger.info("Time to first step: {:.1f}s".format(time.time() - start_time))
 
         # ============ update memory banks ... ============
-        local_memory_index[start_idx : start_idx + bs] = idx
-        for i, crop_idx in enumerate(args.crops_for_assign):
-            local_memory_embeddings[i][start_idx : start_idx + bs] = \
-                emb[crop_idx * bs : (crop_idx + 1) * bs]
+        with timed("memory_update"):
+            local_memory_index[start_idx : start_idx + bs] = idx
+            for i, crop_idx in enumerate(args.crops_for_assign):
+                local_memory_embeddings[i][start_idx : start_idx + bs].copy_(
+                    emb[crop_idx * bs : (crop_idx + 1) * bs], non_blocking=True)
         start_idx += bs
 
         # ============ misc ... ============
-        losses.update(loss.item(), inputs[0].size(0))
         batch_time.update(time.time() - end)
+        timer.step(iteration)
+        straggler_monitor.update(iteration, batch_time.val, data_time.val)
         end = time.time()
         if args.rank ==0 and it % 50 == 0:
             logger.info(
@@ -309,112 +511,205 @@ def train(loader, model, optimizer, epoch, schedule, local_memory_index, local_m
                     lr=optimizer.optim.param_groups[0]["lr"],
                 )
             )
+    if local_memory_embeddings.device != args.device:
+        # wait for the copies to the host memory bank
+        torch.cuda.current_stream().synchronize()
+    timer.log_summary()
+    # average over all the processes
+    losses.all_reduce()
     return (epoch, losses.avg), local_memory_index, local_memory_embeddings
 
 
-def init_memory(dataloader, model):
+def warmup_loss(output, bs):
+    """
+    loss of the warm-up epoch filling the memory banks with --memory_init lazy:
+    swapped prediction of the Sinkhorn-Knopp codes of the crops_for_assign on
+    the prototypes of every head, as in SwAV, instead of their k-means assignments
+    """
+    loss = 0
+    for h in range(len(args.nmb_prototypes)):
+        for crop_id in args.crops_for_assign:
+            with torch.no_grad():
+                out = output[h][bs * crop_id: bs * (crop_id + 1)].detach()
+                q = distributed_sinkhorn(torch.exp(out / args.epsilon).t(), args.sinkhorn_iterations)
+            subloss = 0
+            for v in np.delete(np.arange(np.sum(args.nmb_crops)), crop_id):
+                log_p = nn.functional.log_softmax(output[h][bs * v: bs * (v + 1)] / args.temperature, dim=1)
+                subloss -= torch.mean(torch.sum(q * log_p, dim=1))
+            loss += subloss / (np.sum(args.nmb_crops) - 1)
+    return loss / (len(args.nmb_prototypes) * len(args.crops_for_assign))
+
+
+def build_memory(size_memory_per_process):
+    """empty embeddings of the memory banks, in the precision and at the location of the arguments"""
+    return empty_memory(
+        (len(args.crops_for_assign), size_memory_per_process, args.feat_dim),
+        dtype=args.memory_dtype,
+        location=args.memory_location,
+        path=memory_path(),
+        device=args.device,
+    )
+
+
+def memory_path(name=""):
+    """file of the memory-mapped memory banks of this process, or of their copy `name`"""
+    return os.path.join(
+        args.memory_dir or args.dump_path, "memory" + str(args.rank) + ("-" + name if name else "") + ".bin"
+    )
+
+
+def load_memory(paths, nmb_batches):
+    """
+    memory banks of this process read from the ones saved by all the processes
+    of a job in `paths`, resharded if their number or size changed
+    """
+    size_memory_per_process = nmb_batches * args.batch_size
+    start = args.rank * size_memory_per_process
+    local_memory_index = load_rows(
+        paths, lambda ckp: ckp["local_memory_index"], start, size_memory_per_process,
+    ).to(args.device)
+    local_memory_embeddings = build_memory(size_memory_per_process)
+    saved_embeddings = load_rows(
+        paths, lambda ckp: ckp["local_memory_embeddings"], start, size_memory_per_process, dim=1,
+    )
+    assert saved_embeddings.shape == local_memory_embeddings.shape, \
+        "incompatible memory banks of shape {}".format(tuple(saved_embeddings.shape))
+    local_memory_embeddings.copy_(saved_embeddings)
+    return local_memory_index, local_memory_embeddings
+
+
+def init_memory(dataloader, model, mixed_precision, fraction=1.):
+    """
+    fill the memory banks with the embeddings of the first `fraction` of the
+    batches, repeated over the rest of the memory banks
+    """
     size_memory_per_process = len(dataloader) * args.batch_size
-    local_memory_index = torch.zeros(size_memory_per_process).long().cuda()
-    local_memory_embeddings = torch.zeros(len(args.crops_for_assign), size_memory_per_process, args.feat_dim).cuda()
+    nmb_batches = max(1, math.ceil(fraction * len(dataloader)))
+    local_memory_index = torch.zeros(size_memory_per_process, dtype=torch.long, device=args.device)
+    local_memory_embeddings = build_memory(size_memory_per_process)
     start_idx = 0
     with torch.no_grad():
         logger.info('Start initializing the memory banks')
-        for index, inputs in dataloader:
+        for it, (index, inputs) in enumerate(dataloader):
+            if it == nmb_batches:
+                break
             nmb_unique_idx = inputs[0].size(0)
-            index = index.cuda(non_blocking=True)
+            index = index.to(args.device, non_blocking=True)
 
             # get embeddings
             outputs = []
             for crop_idx in args.crops_for_assign:
-                inp = inputs[crop_idx].cuda(non_blocking=True)
-                outputs.append(model(inp)[0])
+                inp = inputs[crop_idx].to(args.device, non_blocking=True)
+                with mixed_precision.autocast():
+                    outputs.append(model(inp)[0].float())
 
             # fill the memory bank
             local_memory_index[start_idx : start_idx + nmb_unique_idx] = index
             for mb_idx, embeddings in enumerate(outputs):
                 local_memory_embeddings[mb_idx][
                     start_idx : start_idx + nmb_unique_idx
-                ] = embeddings
+                ].copy_(embeddings, non_blocking=True)
             start_idx += nmb_unique_idx
+        if local_memory_embeddings.device != args.device:
+            torch.cuda.current_stream().synchronize()
+
+        # bootstrap from a subset: k-means sees every embedded sample (almost) equally often
+        if start_idx < size_memory_per_process:
+            rows = torch.arange(start_idx, size_memory_per_process) % start_idx
+            local_memory_index[start_idx:] = local_memory_index[rows.to(args.device)]
+            local_memory_embeddings[:, start_idx:] = local_memory_embeddings[:, rows.to(local_memory_embeddings.device)]
     logger.info('Initializion of the memory banks done.')
     return local_memory_index, local_memory_embeddings
 
 
-def cluster_memory(model, local_memory_index, local_memory_embeddings, size_dataset, nmb_kmeans_iters=10):
+def set_prototypes(model, centroids):
+    with torch.no_grad():
+        for w, c in zip(model.module.prototypes.head_weights(), centroids):
+            w.copy_(c)
+
+
+def cluster_memory(prototypes, local_memory_embeddings, nmb_kmeans_iters=10, warm_start=False, group=None):
+    """
+    Distributed k-means over the memory banks, one head per memory bank in turn.
+    `prototypes` are the weights of the heads, used as the initial centroids if
+    `warm_start`. Collectives run in `group`.
+    Return the assignments of the local memory bank (heads x N) and the
+    centroids of every head.
+    """
     j = 0
-    assignments = -100 * torch.ones(len(args.nmb_prototypes), size_dataset).long()
+    device = prototypes[0].device
+    centroids_all = []
+    local_assignments_all = []
+    size_memory = local_memory_embeddings.size(1) * args.world_size
     with torch.no_grad():
         for i_K, K in enumerate(args.nmb_prototypes):
             # run distributed k-means
 
-            # init centroids with elements from memory bank of rank 0
-            centroids = torch.empty(K, args.feat_dim).cuda(non_blocking=True)
-            if args.rank == 0:
-                random_idx = torch.randperm(len(local_memory_embeddings[j]))[:K]
-                assert len(random_idx) >= K, "please reduce the number of centroids"
-                centroids = local_memory_embeddings[j][random_idx]
-            dist.broadcast(centroids, 0)
-
+            with timed("kmeans_init"):
+                if warm_start:
+                    # start from the prototypes of the previous epoch
+                    centroids = nn.functional.normalize(prototypes[i_K], dim=1, p=2)
+                elif args.kmeans_init == "kmeans++":
+                    centroids = kmeans_plus_plus(
+                        local_memory_embeddings[j], K, seed=args.seed + i_K, group=group,
+                        chunk_size=args.kmeans_chunk_size, device=device,
+                    )
+                else:
+                    # init centroids with elements from memory bank of rank 0
+                    centroids = torch.empty(K, args.feat_dim, device=device)
+                    if args.rank == 0:
+                        random_idx = torch.randperm(len(local_memory_embeddings[j]))[:K]
+                        assert len(random_idx) >= K, "please reduce the number of centroids"
+                        centroids = local_memory_embeddings[j][random_idx].to(device, torch.float32)
+                    broadcast_(centroids, 0, group=group)
+
+            changed = 1.
             for n_iter in range(nmb_kmeans_iters + 1):
 
                 # E step
-                dot_products = torch.mm(local_memory_embeddings[j], centroids.t())
-                _, local_assignments = dot_products.max(dim=1)
+                with timed("kmeans_e_step"):
+                    local_assignments = nearest_centroids(
+                        local_memory_embeddings[j], centroids, args.kmeans_chunk_size,
+                    )
 
                 # finish
                 if n_iter == nmb_kmeans_iters:
                     break
 
+                # stop once the assignments are stable
+                if n_iter > 0 and args.kmeans_tol > 0:
+                    changed = (local_assignments != previous_assignments).sum()
+                    all_reduce_(changed, group=group)
+                    changed = changed.item() / size_memory
+                    if changed < args.kmeans_tol:
+                        break
+                previous_assignments = local_assignments
+
                 # M step
-                where_helper = get_indices_sparse(local_assignments.cpu().numpy())
-                counts = torch.zeros(K).cuda(non_blocking=True).int()
-                emb_sums = torch.zeros(K, args.feat_dim).cuda(non_blocking=True)
-                for k in range(len(where_helper)):
-                    if len(where_helper[k][0]) > 0:
-                        emb_sums[k] = torch.sum(
-                            local_memory_embeddings[j][where_helper[k][0]],
-                            dim=0,
-                        )
-                        counts[k] = len(where_helper[k][0])
-                dist.all_reduce(counts)
+                with timed("kmeans_m_step"):
+                    emb_sums, counts = cluster_sums(
+                        local_memory_embeddings[j], local_assignments, K, args.kmeans_chunk_size,
+                    )
+                with timed("kmeans_allreduce"):
+                    all_reduce_(counts, group=group)
+                    all_reduce_(emb_sums, group=group)
                 mask = counts > 0
-                dist.all_reduce(emb_sums)
                 centroids[mask] = emb_sums[mask] / counts[mask].unsqueeze(1)
 
                 # normalize centroids
                 centroids = nn.functional.normalize(centroids, dim=1, p=2)
 
-            getattr(model.module.prototypes, "prototypes" + str(i_K)).weight.copy_(centroids)
+            centroids_all.append(centroids)
+            logger.info("k-means with {} centroids: {} iterations{}".format(
+                K, n_iter, ", {:.4f} of the assignments changed at the last one".format(changed)
+                if n_iter > 0 and args.kmeans_tol > 0 else ""))
 
-            # gather the assignments
-            assignments_all = torch.empty(args.world_size, local_assignments.size(0),
-                                          dtype=local_assignments.dtype, device=local_assignments.device)
-            assignments_all = list(assignments_all.unbind(0))
-            dist_process = dist.all_gather(assignments_all, local_assignments, async_op=True)
-            dist_process.wait()
-            assignments_all = torch.cat(assignments_all).cpu()
-
-            # gather the indexes
-            indexes_all = torch.empty(args.world_size, local_memory_index.size(0),
-                                      dtype=local_memory_index.dtype, device=local_memory_index.device)
-            indexes_all = list(indexes_all.unbind(0))
-            dist_process = dist.all_gather(indexes_all, local_memory_index, async_op=True)
-            dist_process.wait()
-            indexes_all = torch.cat(indexes_all).cpu()
-
-            # log assignments
-            assignments[i_K][indexes_all] = assignments_all
+            local_assignments_all.append(local_assignments)
 
             # next memory bank to use
             j = (j + 1) % len(args.crops_for_assign)
 
-    return assignments
-
-
-def get_indices_sparse(data):
-    cols = np.arange(data.size)
-    M = csr_matrix((cols, (data.ravel(), cols)), shape=(int(data.max()) + 1, data.size))
-    return [np.unravel_index(row.data, data.shape) for row in M]
+    return torch.stack(local_assignments_all), centroids_all
 
 
 if __name__ == "__main__":
@@ -7,7 +7,6 @@
 import argparse
 import math
 import os
-import shutil
 import time
 from logging import getLogger
 
@@ -18,8 +17,6 @@ import torch.nn.parallel
 import torch.backends.cudnn as cudnn
 import torch.distributed as dist
 import torch.optim
-import apex
-from apex.parallel.LARC import LARC
 
 from swav.utils import (
     bool_flag,
@@ -27,21 +24,43 @@ from swav.utils import (
     restart_from_checkpoint,
     fix_random_seeds,
     AverageMeter,
+    DeviceMeter,
     init_distributed_mode,
 )
+from swav.mixed_precision import MixedPrecision, PRECISIONS
+from swav.optim import LARC, build_optimizer, consolidate_state_dict
+from swav.profiler import StepTimer, StragglerMonitor, parse_steps, timed
+from swav.checkpoint import CheckpointWriter, CHECKPOINT_READS, load_rows, mmap_load, shard_paths
+from swav.distributed import (
+    all_gather_with_grad,
+    sharded_log_softmax,
+    new_node_group,
+    CommHook,
+    COMM_HOOKS,
+)
+from swav.sinkhorn import (
+    distributed_sinkhorn,
+    sharded_sinkhorn,
+    topk_scores,
+    topk_sinkhorn,
+    topk_assignment_error,
+    ReducedSyncSinkhorn,
+    equipartition_deviation,
+)
 
 from swav.multicropdataset import MultiCropDataset
 from swav.swav_transforms import SwAVTrainDataTransform
 from swav.stl10_datamodule import STL10DataModule, stl10_normalization
 import swav.resnet50 as resnet_models
+from swav.resnet50 import ShardedPrototypes
 
 from torch.utils.tensorboard import SummaryWriter
 
-# single node single GPU training
-os.environ["RANK"] = '0'
-os.environ["WORLD_SIZE"] = '1'
-os.environ["MASTER_ADDR"] = '127.0.0.1'
-os.environ['MASTER_PORT'] = '29500'
+# single process training by default, torchrun and SLURM set their own values
+os.environ.setdefault("RANK", "0")
+os.environ.setdefault("WORLD_SIZE", "1")
+os.environ.setdefault("MASTER_ADDR", "127.0.0.1")
+os.environ.setdefault("MASTER_PORT", "29500")
 
 logger = getLogger()
 
@@ -78,6 +97,18 @@ parser.add_argument("--epsilon", default=0.05, type=float,
                     help="regularization parameter for Sinkhorn-Knopp algorithm")
 parser.add_argument("--sinkhorn_iterations", default=3, type=int,
                     help="number of iterations in Sinkhorn-Knopp algorithm")
+parser.add_argument("--sinkhorn_topk", default=0, type=int,
+                    help="only keep the top-k prototypes of every sample in Sinkhorn-Knopp (0 for dense)")
+parser.add_argument("--sinkhorn_topk_check_freq", default=500, type=int,
+                    help="compare the top-k assignments with the dense ones every this many iterations (0 to disable)")
+parser.add_argument("--sinkhorn_sync", default="exact", type=str, choices=["exact", "node", "local"],
+                    help="""reduce the marginals of the prototypes at every Sinkhorn-Knopp iteration
+                    over all the processes (exact), the processes of the node (node) or not at all
+                    (local), in the last two cases they are synchronized globally once per step""")
+parser.add_argument("--sinkhorn_async", type=bool_flag, default=False,
+                    help="synchronize the marginals of the prototypes in the background, one step late")
+parser.add_argument("--nmb_processes_per_node", default=8, type=int,
+                    help="number of processes per node, used for --sinkhorn_sync node")
 parser.add_argument("--feat_dim", default=128, type=int,
                     help="feature dimension")
 parser.add_argument("--nmb_prototypes", default=256, type=int,
@@ -86,6 +117,8 @@ parser.add_argument("--queue_length", type=int, default=3840,
                     help="length of the queue (0 for no queue)")
 parser.add_argument("--epoch_queue_starts", type=int, default=15,
                     help="from this epoch, we start using a queue")
+parser.add_argument("--shard_prototypes", type=bool_flag, default=False,
+                    help="split the prototypes across the processes (model parallel)")
 
 #########################
 #### optim parameters ###
@@ -106,6 +139,8 @@ parser.add_argument("--wd", default=1e-6, type=float, help="weight decay")
 parser.add_argument("--warmup_epochs", default=10, type=int, help="number of warmup epochs")
 parser.add_argument("--start_warmup", default=0, type=float,
                     help="initial warmup learning rate")
+parser.add_argument("--zero_optimizer", type=bool_flag, default=False,
+                    help="partition the optimizer state across the processes (ZeRO)")
 
 #########################
 #### dist parameters ###
@@ -119,6 +154,18 @@ parser.add_argument("--rank", default=0, type=int, help="""rank of this process:
                     it is set automatically and should not be passed as argument""")
 parser.add_argument("--local_rank", default=0, type=int,
                     help="this argument is not used and should be ignored")
+parser.add_argument("--dist_backend", default="auto", type=str, choices=["auto", "nccl", "gloo"],
+                    help="""nccl to run on GPUs or gloo to run on CPUs, auto selects nccl if GPUs
+                    are available""")
+parser.add_argument("--checkpoint_read", type=str, default="single", choices=CHECKPOINT_READS,
+                    help="""processes reading the checkpoints when resuming: all of them, the first
+                    one of every node or a single one, broadcasting to the others""")
+parser.add_argument("--comm_hook", type=str, default="none", choices=COMM_HOOKS,
+                    help="compression of the gradients all-reduced by DDP")
+parser.add_argument("--powersgd_rank", type=int, default=1,
+                    help="rank of the low-rank approximation of the gradients with --comm_hook powersgd")
+parser.add_argument("--powersgd_start_iter", type=int, default=1000,
+                    help="all-reduce the full gradients during this many iterations with --comm_hook powersgd")
 
 #########################
 #### other parameters ###
@@ -130,12 +177,18 @@ parser.add_argument("--workers", default=16, type=int,
                     help="number of data loading workers")
 parser.add_argument("--checkpoint_freq", type=int, default=20,
                     help="Save the model periodically")
-parser.add_argument("--use_fp16", type=bool_flag, default=True,
-                    help="whether to train with mixed precision or not")
+parser.add_argument("--precision", type=str, default="fp16", choices=list(PRECISIONS),
+                    help="train in full precision (fp32) or with fp16 / bf16 mixed precision")
 parser.add_argument("--sync_bn", type=str, default="pytorch", help="synchronize bn")
 parser.add_argument("--dump_path", type=str, default=".",
                     help="experiment dump path for checkpoints and log")
 parser.add_argument("--seed", type=int, default=31, help="seed")
+parser.add_argument("--step_timing", type=bool_flag, default=False, help="""time the phases of
+                    the training step, logged per epoch, in timing{rank}.csv and in TensorBoard""")
+parser.add_argument("--profile_steps", type=str, default="", help="""run the torch profiler
+                    between these iterations (start:end) and export its Chrome trace""")
+parser.add_argument("--straggler_freq", type=int, default=100, help="""compare the step and data
+                    times of the processes every this many iterations to detect the stragglers (0 to disable)""")
 
 
 def exclude_from_wt_decay(named_params, weight_decay, skip_list=['bias', 'bn']):
@@ -162,8 +215,30 @@ def main():
     init_distributed_mode(args)
     fix_random_seeds(args.seed)
     logger, training_stats = initialize_exp(args, "epoch", "loss")
+    assert not (args.shard_prototypes and args.sinkhorn_topk > 0), \
+        "top-k Sinkhorn-Knopp is not supported with sharded prototypes"
+    assert args.sinkhorn_sync == "exact" or not (args.shard_prototypes or args.sinkhorn_topk > 0), \
+        "reduced synchronization of Sinkhorn-Knopp is only supported with dense prototypes"
+    assert not (args.shard_prototypes and args.zero_optimizer), \
+        "the optimizer state cannot be partitioned with sharded prototypes"
     writer = SummaryWriter()
 
+    # instrumentation of the training step
+    timer = StepTimer(
+        enabled=args.step_timing,
+        csv_path=os.path.join(args.dump_path, "timing" + str(args.rank) + ".csv"),
+        tb_writer=writer if args.rank == 0 else None,
+        profile_steps=parse_steps(args.profile_steps),
+        trace_dir=args.dump_path,
+        rank=args.rank,
+        device=args.device,
+    ).activate()
+    straggler_monitor = StragglerMonitor(
+        args.straggler_freq,
+        stats_path=os.path.join(args.dump_path, "stragglers.jsonl"),
+        rank=args.rank,
+    )
+
     # build data
     if args.dataset == 'imagenet':
         train_dataset = MultiCropDataset(
@@ -179,7 +254,7 @@ def main():
             sampler=sampler,
             batch_size=args.batch_size,
             num_workers=args.workers,
-            pin_memory=True,
+            pin_memory=args.device.type == "cuda",
             drop_last=True
         )
     elif args.dataset == 'stl10':
@@ -219,44 +294,64 @@ def main():
         normalize=True,
         hidden_mlp=args.hidden_mlp,
         output_dim=args.feat_dim,
-        nmb_prototypes=args.nmb_prototypes,
+        nmb_prototypes=0 if args.shard_prototypes else args.nmb_prototypes,
+        freeze_prototypes_niters=args.freeze_prototypes_niters,
     )
 
     if args.dataset == 'stl10':
         model.maxpool = nn.MaxPool2d(kernel_size=1, stride=1)
 
-    # synchronize batch norm layers
-    if args.sync_bn == "pytorch":
+    # synchronize batch norm layers (SyncBatchNorm only runs on GPU)
+    if args.sync_bn == "pytorch" and args.device.type == "cuda":
         model = nn.SyncBatchNorm.convert_sync_batchnorm(model)
-    elif args.sync_bn == "apex":
+    elif args.sync_bn == "apex" and args.device.type == "cuda":
+        import apex
         process_group = None
         if args.world_size // 8 > 0:
             process_group = apex.parallel.create_syncbn_process_group(args.world_size // 8)
         model = apex.parallel.convert_syncbn_model(model, process_group=process_group)
-    # copy model to GPU
-    model = model.cuda()
+    # the sharded prototypes are kept out of the model replicated by DDP
+    prototypes = None
+    if args.shard_prototypes:
+        prototypes = ShardedPrototypes(
+            args.feat_dim,
+            args.nmb_prototypes,
+            freeze_niters=args.freeze_prototypes_niters,
+        ).to(args.device)
+
+    # copy model to the device
+    model = model.to(args.device)
     if args.rank == 0:
         logger.info(model)
+        if prototypes is not None:
+            logger.info(prototypes)
     logger.info("Building model done.")
 
-    params = None
+    named_params = list(model.named_parameters())
+    if prototypes is not None:
+        named_params += list(prototypes.named_parameters(prefix="prototypes"))
+    params = [p for _, p in named_params]
     if args.exclude_bn_bias:
         params = exclude_from_wt_decay(
-            model.named_parameters(),
+            named_params,
             weight_decay=args.wd
         )
 
     # build optimizer
     if args.optimizer == 'sgd':
-        optimizer = torch.optim.SGD(
-            params if args.exclude_bn_bias else model.parameters(),
+        optimizer = build_optimizer(
+            torch.optim.SGD,
+            params,
+            zero=args.zero_optimizer,
             lr=args.base_lr,
             momentum=0.9,
             weight_decay=args.wd,
         )
     elif args.optimizer == 'adam':
-        optimizer = torch.optim.Adam(
-            params if args.exclude_bn_bias else model.parameters(),
+        optimizer = build_optimizer(
+            torch.optim.Adam,
+            params,
+            zero=args.zero_optimizer,
             lr=args.base_lr,
             weight_decay=args.wd
         )
@@ -270,35 +365,86 @@ def main():
     logger.info("Building optimizer done.")
 
     # init mixed precision
-    if args.use_fp16:
-        model, optimizer = apex.amp.initialize(model, optimizer, opt_level="O1")
-        logger.info("Initializing mixed precision done.")
+    mixed_precision = MixedPrecision(args.precision, device_type=args.device.type)
+    logger.info("Initializing {} precision done.".format(args.precision))
 
     # wrap model
     model = nn.parallel.DistributedDataParallel(
         model,
-        device_ids=[args.gpu_to_work_on],
+        device_ids=None if args.gpu_to_work_on is None else [args.gpu_to_work_on],
         find_unused_parameters=True,
     )
+    comm_hook = CommHook(model, args.comm_hook, args.powersgd_rank, args.powersgd_start_iter, timer=timer)
+    logger.info("Using communication hook: {}".format(comm_hook))
 
     # optionally resume from a checkpoint
-    to_restore = {"epoch": 0}
+    to_restore = {"epoch": 0, "world_size": args.world_size}
     restart_from_checkpoint(
         os.path.join(args.dump_path, "checkpoint.pth.tar"),
         run_variables=to_restore,
+        read=args.checkpoint_read,
         state_dict=model,
         optimizer=optimizer,
-        amp=apex.amp,
+        scaler=mixed_precision,
+        comm_hook=comm_hook,
     )
     start_epoch = to_restore["epoch"]
+    # the per-process states below are resharded if the number of processes changed
+    prev_world_size = to_restore["world_size"]
+    if prototypes is None:
+        prototypes = model.module.prototypes
+
+    # each process keeps its own shard of the prototypes and of their optimizer state
+    prototypes_path = os.path.join(args.dump_path, "prototypes" + str(args.rank) + ".pth")
+    prev_paths = shard_paths(args.dump_path, "prototypes", prev_world_size)
+    if args.shard_prototypes and all(os.path.isfile(p) for p in prev_paths):
+        shard_size = prototypes.weight.size(0)
+        prototypes.load_state_dict({"weight": load_rows(
+            prev_paths, lambda ckp: ckp["state_dict"]["weight"], args.rank * shard_size, shard_size,
+        )})
+        # the states of the prototypes (e.g. momentum) are resharded, the others
+        # (e.g. the step of Adam) are the same in all the shards and copied as they are
+        saved = mmap_load(prev_paths[0])
+        saved_rows = saved["state_dict"]["weight"].size(0)
+        optimizer.optim.state[prototypes.weight] = {
+            k: load_rows(
+                prev_paths, lambda ckp: ckp["optimizer_state"][k], args.rank * shard_size, shard_size,
+            ).to(args.device)
+            if torch.is_tensor(v) and v.dim() > 0 and v.size(0) == saved_rows else
+            (v.clone() if torch.is_tensor(v) else v)
+            for k, v in saved["optimizer_state"].items()
+        }
+
+    # the queue needs to be divisible by the batch size
+    args.queue_length -= args.queue_length % (args.batch_size * args.world_size)
+    # with sharded prototypes, every process scores the embeddings of the global batch
+    queue_length = args.queue_length if args.shard_prototypes else args.queue_length // args.world_size
 
     # build the queue
     queue = None
     queue_path = os.path.join(args.dump_path, "queue" + str(args.rank) + ".pth")
-    if os.path.isfile(queue_path):
-        queue = torch.load(queue_path)["queue"]
-    # the queue needs to be divisible by the batch size
-    args.queue_length -= args.queue_length % (args.batch_size * args.world_size)
+    prev_paths = shard_paths(args.dump_path, "queue", prev_world_size)
+    if args.queue_length > 0 and all(os.path.isfile(p) for p in prev_paths):
+        # the queues of all the processes form the global queue
+        queue = load_rows(
+            prev_paths,
+            lambda ckp: ckp["queue"],
+            0 if args.shard_prototypes else args.rank * queue_length,
+            queue_length,
+            dim=1,
+        ).to(args.device)
+
+    # build the Sinkhorn-Knopp solvers with reduced synchronization
+    sinkhorns = None
+    if args.sinkhorn_sync != "exact":
+        group = new_node_group(args.nmb_processes_per_node) if args.sinkhorn_sync == "node" else None
+        sinkhorns = [
+            ReducedSyncSinkhorn(args.sinkhorn_iterations, group=group, async_sync=args.sinkhorn_async)
+            for _ in args.crops_for_assign
+        ]
+
+    # checkpoints are written in the background
+    checkpoint_writer = CheckpointWriter()
 
     cudnn.benchmark = True
 
@@ -314,45 +460,71 @@ def main():
         if args.queue_length > 0 and epoch >= args.epoch_queue_starts and queue is None:
             queue = torch.zeros(
                 len(args.crops_for_assign),
-                args.queue_length // args.world_size,
+                queue_length,
                 args.feat_dim,
-            ).cuda()
+                device=args.device,
+            )
 
         # train the network
-        scores, queue = train(train_loader, model, optimizer, epoch, lr_schedule, queue)
-        training_stats.update(scores)
+        scores, queue = train(
+            train_loader,
+            model,
+            prototypes,
+            optimizer,
+            mixed_precision,
+            epoch,
+            lr_schedule,
+            queue,
+            sinkhorns,
+            timer,
+            straggler_monitor,
+        )
+        training_stats.update(scores, save=True)
         writer.add_scalar("Loss/train", scores[1], scores[0])
 
         # save checkpoints
+        consolidate_state_dict(optimizer)
         if args.rank == 0:
             save_dict = {
                 "epoch": epoch + 1,
                 "state_dict": model.state_dict(),
                 "optimizer": optimizer.state_dict(),
+                "comm_hook": comm_hook.state_dict(),
+                "world_size": args.world_size,
             }
-            if args.use_fp16:
-                save_dict["amp"] = apex.amp.state_dict()
-            torch.save(
+            if mixed_precision.enabled:
+                save_dict["scaler"] = mixed_precision.state_dict()
+            copies = []
+            if epoch % args.checkpoint_freq == 0 or epoch == args.epochs - 1:
+                copies.append(os.path.join(args.dump_checkpoints, "ckp-" + str(epoch) + ".pth"))
+            checkpoint_writer.save(
                 save_dict,
                 os.path.join(args.dump_path, "checkpoint.pth.tar"),
+                copies=copies,
             )
-            if epoch % args.checkpoint_freq == 0 or epoch == args.epochs - 1:
-                shutil.copyfile(
-                    os.path.join(args.dump_path, "checkpoint.pth.tar"),
-                    os.path.join(args.dump_checkpoints, "ckp-" + str(epoch) + ".pth"),
-                )
+        if args.shard_prototypes:
+            checkpoint_writer.save({
+                "state_dict": prototypes.state_dict(),
+                "optimizer_state": optimizer.optim.state[prototypes.weight],
+            }, prototypes_path)
         if queue is not None:
-            torch.save({"queue": queue}, queue_path)
+            checkpoint_writer.save({"queue": queue}, queue_path)
 
     writer.flush()
+    checkpoint_writer.wait()
 
 
-def train(train_loader, model, optimizer, epoch, lr_schedule, queue):
+def train(train_loader, model, prototypes, optimizer, mixed_precision, epoch, lr_schedule, queue,
+          sinkhorns=None, timer=None, straggler_monitor=None):
     batch_time = AverageMeter()
     data_time = AverageMeter()
-    losses = AverageMeter()
+    losses = DeviceMeter()
+    topk_errors = DeviceMeter()
+    deviations = DeviceMeter()
 
-    softmax = nn.Softmax(dim=1).cuda()
+    softmax = nn.Softmax(dim=1)
+    timer = timer or StepTimer()
+    straggler_monitor = straggler_monitor or StragglerMonitor(0)
     model.train()
     use_the_queue = False
 
@@ -360,6 +532,7 @@ def train(train_loader, model, optimizer, epoch, lr_schedule, queue):
     for it, inputs in enumerate(train_loader):
         # measure data loading time
         data_time.update(time.time() - end)
+        timer.add("data", data_time.val)
 
         # update learning rate
         iteration = epoch * len(train_loader) + it
@@ -367,62 +540,114 @@ def train(train_loader, model, optimizer, epoch, lr_schedule, queue):
             param_group["lr"] = lr_schedule[iteration]
 
         # normalize the prototypes
-        with torch.no_grad():
-            w = model.module.prototypes.weight.data.clone()
-            w = nn.functional.normalize(w, dim=1, p=2)
-            model.module.prototypes.weight.copy_(w)
+        prototypes.normalize()
 
         # ============ multi-res forward passes ... ============
-        embedding, output = model(inputs)
-        embedding = embedding.detach()
-        bs = inputs[0].size(0)
+        with mixed_precision.autocast():
+            if args.shard_prototypes:
+                # score the embeddings of the global batch against the local prototypes
+                embedding = model(inputs)
+                with timed("gather_embeddings"):
+                    embedding = all_gather_with_grad(embedding)
+                embedding = embedding.view(args.world_size, len(inputs), -1, args.feat_dim)
+                embedding = embedding.transpose(0, 1).reshape(-1, args.feat_dim)
+                with timed("prototypes"):
+                    output = prototypes(embedding)
+            else:
+                embedding, output = model(inputs)
+        # Sinkhorn-Knopp and the loss are computed in fp32
+        embedding, output = embedding.detach().float(), output.float()
+        bs = embedding.size(0) // len(inputs)
 
         # ============ swav loss ... ============
         loss = 0
         for i, crop_id in enumerate(args.crops_for_assign):
             with torch.no_grad():
                 out = output[bs * crop_id: bs * (crop_id + 1)]
+                emb = embedding[bs * crop_id: bs * (crop_id + 1)]
+                if args.sinkhorn_topk > 0:
+                    # sparse approximation, only the top-k prototypes of every sample are kept:
+                    # the batch reuses the scores of the loss, only the queue is scored here
+                    check_topk = args.sinkhorn_topk_check_freq > 0 and it % args.sinkhorn_topk_check_freq == 0
+                    out, q_idx = out.topk(args.sinkhorn_topk, dim=1)
 
                 # time to use the queue
-                if queue is not None:
-                    if use_the_queue or not torch.all(queue[i, -1, :] == 0):
-                        use_the_queue = True
-                        out = torch.cat((torch.mm(
-                            queue[i],
-                            model.module.prototypes.weight.t()
-                        ), out))
-                    # fill the queue
-                    queue[i, bs:] = queue[i, :-bs].clone()
-                    queue[i, :bs] = embedding[crop_id * bs: (crop_id + 1) * bs]
+                with timed("queue"):
+                    if queue is not None:
+                        if use_the_queue or not torch.all(queue[i, -1, :] == 0):
+                            use_the_queue = True
+                            if args.sinkhorn_topk > 0:
+                                queue_out, queue_idx = topk_scores(queue[i], prototypes.weight, args.sinkhorn_topk)
+                                out, q_idx = torch.cat((queue_out, out)), torch.cat((queue_idx, q_idx))
+                                if check_topk:
+                                    emb = torch.cat((queue[i], emb))
+                            else:
+                                out = torch.cat((torch.mm(
+                                    queue[i],
+                                    prototypes.weight.t()
+                                ), out))
+                        # fill the queue
+                        queue[i, bs:] = queue[i, :-bs].clone()
+                        queue[i, :bs] = embedding[crop_id * bs: (crop_id + 1) * bs]
                 # get assignments
-                q = torch.exp(out / args.epsilon).t()
-                q = distributed_sinkhorn(q, args.sinkhorn_iterations)[-bs:]
+                with timed("sinkhorn"):
+                    if args.sinkhorn_topk > 0:
+                        q = topk_sinkhorn(
+                            torch.exp(out / args.epsilon),
+                            q_idx,
+                            prototypes.weight.size(0),
+                            args.sinkhorn_iterations,
+                        )
+                    else:
+                        q = torch.exp(out / args.epsilon).t()
+                        if args.shard_prototypes:
+                            q = sharded_sinkhorn(q, args.sinkhorn_iterations)[-bs:]
+                        elif sinkhorns is not None:
+                            q = sinkhorns[i](q)[-bs:]
+                        else:
+                            q = distributed_sinkhorn(q, args.sinkhorn_iterations)[-bs:]
+                if args.sinkhorn_topk > 0:
+                    if check_topk:
+                        dense_q = torch.exp(torch.mm(emb, prototypes.weight.t()) / args.epsilon).t()
+                        dense_q = distributed_sinkhorn(dense_q, args.sinkhorn_iterations)
+                        topk_errors.update(topk_assignment_error(dense_q, q, q_idx))
+                    q, q_idx = q[-bs:], q_idx[-bs:]
+                elif not args.shard_prototypes and i == 0 and it % 50 == 0:
+                    deviations.update(equipartition_deviation(q))
 
             # cluster assignment prediction
-            subloss = 0
-            for v in np.delete(np.arange(np.sum(args.nmb_crops)), crop_id):
-                p = softmax(output[bs * v: bs * (v + 1)] / args.temperature)
-                subloss -= torch.mean(torch.sum(q * torch.log(p), dim=1))
-            loss += subloss / (np.sum(args.nmb_crops) - 1)
+            with timed("loss"):
+                subloss = 0
+                for v in np.delete(np.arange(np.sum(args.nmb_crops)), crop_id):
+                    x = output[bs * v: bs * (v + 1)] / args.temperature
+                    if args.shard_prototypes:
+                        log_p = sharded_log_softmax(x)
+                    else:
+                        log_p = torch.log(softmax(x))
+                    if args.sinkhorn_topk > 0:
+                        log_p = log_p.gather(1, q_idx)
+                    subloss -= torch.mean(torch.sum(q * log_p, dim=1))
+                loss += subloss / (np.sum(args.nmb_crops) - 1)
         loss /= len(args.crops_for_assign)
 
         # ============ backward and optim step ... ============
         optimizer.zero_grad()
-        if args.use_fp16:
-            with apex.amp.scale_loss(loss, optimizer) as scaled_loss:
-                scaled_loss.backward()
-        else:
-            loss.backward()
-        # cancel some gradients
-        if iteration < args.freeze_prototypes_niters:
-            for name, p in model.named_parameters():
-                if "prototypes" in name:
-                    p.grad = None
-        optimizer.step()
+        with timed("backward"):
+            mixed_precision.backward(loss)
+        with timed("optimizer"):
+            # cancel some gradients
+            prototypes.cancel_gradients(iteration)
+            mixed_precision.step(optimizer)
 
         # ============ misc ... ============
-        losses.update(loss.item(), inputs[0].size(0))
+        if args.shard_prototypes:
+            # the local loss only covers the local prototypes
+            loss = loss.detach()
+            dist.all_reduce(loss)
+        losses.update(loss, inputs[0].size(0))
         batch_time.update(time.time() - end)
+        timer.step(iteration)
+        straggler_monitor.update(iteration, batch_time.val, data_time.val)
         end = time.time()
         if args.rank ==0 and it % 50 == 0:
             logger.info(
@@ -439,30 +664,16 @@ def train(train_loader, model, optimizer, epoch, lr_schedule, queue):
                     lr=optimizer.optim.param_groups[0]["lr"],
                 )
             )
+    timer.log_summary()
+    # average over all the processes
+    losses.all_reduce()
+    if args.rank == 0 and deviations.count > 0:
+        logger.info("Sinkhorn-Knopp ({}): equipartition deviation {:.4f}".format(
+            args.sinkhorn_sync, deviations.avg))
+    if args.rank == 0 and topk_errors.count > 0:
+        logger.info("Top-k Sinkhorn: total variation to the dense assignments {:.4f}".format(topk_errors.avg))
     return (epoch, losses.avg), queue
 
 
-def distributed_sinkhorn(Q, nmb_iters):
-    with torch.no_grad():
-        sum_Q = torch.sum(Q)
-        dist.all_reduce(sum_Q)
-        Q /= sum_Q
-
-        u = torch.zeros(Q.shape[0]).cuda(non_blocking=True)
-        r = torch.ones(Q.shape[0]).cuda(non_blocking=True) / Q.shape[0]
-        c = torch.ones(Q.shape[1]).cuda(non_blocking=True) / (args.world_size * Q.shape[1])
-
-        curr_sum = torch.sum(Q, dim=1)
-        dist.all_reduce(curr_sum)
-
-        for it in range(nmb_iters):
-            u = curr_sum
-            Q *= (r / u).unsqueeze(1)
-            Q *= (c / torch.sum(Q, dim=0)).unsqueeze(0)
-            curr_sum = torch.sum(Q, dim=1)
-            dist.all_reduce(curr_sum)
-        return (Q / torch.sum(Q, dim=0, keepdim=True)).t().float()
-
-
 if __name__ == "__main__":
     main()
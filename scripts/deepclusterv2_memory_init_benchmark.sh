@@ -0,0 +1,65 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+
+#!/bin/bash
+#SBATCH --nodes=1
+#SBATCH --gpus=8
+#SBATCH --ntasks-per-node=8
+#SBATCH --cpus-per-task=8
+#SBATCH --job-name=deepclusterv2_memory_init_benchmark
+#SBATCH --time=4:00:00
+#SBATCH --mem=450G
+
+# time from the start of the job to the first optimizer step of DeepCluster-v2
+# for every --memory_init strategy, every run is stopped after its first step
+
+master_node=${SLURM_NODELIST:0:9}${SLURM_NODELIST:10:4}
+dist_url="tcp://"
+dist_url+=$master_node
+dist_url+=:40000
+
+DATASET_PATH="/path/to/imagenet"
+# dump path of a previous DeepCluster-v2 run on the same dataset, for --memory_init file
+MEMORY_INIT_PATH="./experiments/deepclusterv2_400ep_pretrain"
+EXPERIMENT_PATH="./experiments/deepclusterv2_memory_init_benchmark"
+mkdir -p $EXPERIMENT_PATH
+
+for memory_init in full subset file lazy; do
+    dump_path=${EXPERIMENT_PATH}/${memory_init}
+    mkdir -p $dump_path
+    srun --output=${dump_path}/%j.out --error=${dump_path}/%j.err --label python -u main_deepclusterv2.py \
+    --data_path $DATASET_PATH \
+    --nmb_crops 2 6 \
+    --size_crops 224 96 \
+    --min_scale_crops 0.14 0.05 \
+    --max_scale_crops 1. 0.14 \
+    --crops_for_assign 0 1 \
+    --temperature 0.1 \
+    --feat_dim 128 \
+    --nmb_prototypes 3000 3000 3000 \
+    --epochs 400 \
+    --batch_size 64 \
+    --base_lr 4.8 \
+    --final_lr 0.0048 \
+    --freeze_prototypes_niters 300000 \
+    --wd 0.000001 \
+    --warmup_epochs 10 \
+    --start_warmup 0.3 \
+    --memory_init $memory_init \
+    --memory_init_fraction 0.1 \
+    --memory_init_path $MEMORY_INIT_PATH \
+    --dist_url $dist_url \
+    --arch resnet50 \
+    --dump_path $dump_path &
+    job=$!
+    until grep -q "Time to first step" ${dump_path}/train.log 2>/dev/null || ! kill -0 $job 2>/dev/null; do
+        sleep 10
+    done
+    kill $job 2>/dev/null
+    wait $job
+    echo "$memory_init: $(grep -h -o "Time to first step: .*" ${dump_path}/train.log | head -1)"
+done
@@ -46,6 +46,6 @@ srun --output=${EXPERIMENT_PATH}/%j.out --error=${EXPERIMENT_PATH}/%j.err --labe
 --start_warmup 0.3 \
 --dist_url $dist_url \
 --arch resnet50 \
---use_fp16 true \
+--precision fp16 \
 --sync_bn apex \
 --dump_path $EXPERIMENT_PATH
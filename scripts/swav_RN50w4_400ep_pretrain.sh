@@ -49,6 +49,6 @@ srun --output=${EXPERIMENT_PATH}/%j.out --error=${EXPERIMENT_PATH}/%j.err --labe
 --dist_url $dist_url \
 --arch resnet50w4 \
 --hidden_mlp 8192 \
---use_fp16 true \
+--precision fp16 \
 --sync_bn apex \
 --dump_path $EXPERIMENT_PATH
@@ -0,0 +1,291 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+
+from logging import getLogger
+import copy
+import os
+import queue
+import shutil
+import threading
+
+import torch
+import torch.distributed as dist
+
+from swav.distributed import new_node_group
+
+logger = getLogger()
+
+CHECKPOINT_READS = ["all", "node", "single"]
+
+# process groups of the nodes, created once
+_node_groups = {}
+
+# size of the buffers the tensors are packed into to be broadcast
+BROADCAST_BUCKET_SIZE = 256 * 1024 * 1024
+
+
+def snapshot(obj):
+    """
+    Copy all the tensors of a (nested) checkpoint to host memory.
+    Dicts are shallow-copied so that they keep their attributes, e.g. the
+    `_metadata` of a state dict that `load_state_dict` needs.
+    """
+    if torch.is_tensor(obj):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        out = copy.copy(obj)
+        for k, v in obj.items():
+            out[k] = snapshot(v)
+        return out
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot(v) for v in obj)
+    return obj
+
+
+def atomic_save(obj, path):
+    """
+    Save to a temporary file renamed into place once written, so that `path`
+    always holds a complete checkpoint.
+    """
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        torch.save(obj, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def link_or_copy(src, dst):
+    """
+    Hardlink `dst` to `src`, or copy it if the filesystem does not support hardlinks.
+    Since `atomic_save` replaces the file instead of rewriting it, the link keeps
+    the current version.
+    """
+    if os.path.lexists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+class CheckpointWriter(object):
+    """
+    Write checkpoints in a background thread.
+    `save` only takes a snapshot of the tensors in host memory (unless `copy` is
+    False), serializing and writing happen in the order of the calls while
+    training goes on.
+    At most `max_pending` checkpoints wait for the one being written, `save`
+    blocks beyond that, so that snapshots do not pile up in host memory when
+    writing is slower than training.
+    Errors of the background thread are raised at the next call.
+    """
+
+    def __init__(self, max_pending=1):
+        self.jobs = queue.Queue(maxsize=max_pending)
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            obj, path, copies = self.jobs.get()
+            try:
+                atomic_save(obj, path)
+                for copy_path in copies:
+                    link_or_copy(path, copy_path)
+            except Exception as e:
+                logger.error("Failed to save checkpoint {}: {}".format(path, e))
+                self.error = e
+            finally:
+                self.jobs.task_done()
+
+    def _raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def save(self, obj, path, copies=(), copy=True):
+        """
+        Save `obj` to `path`, then link it to every path of `copies`.
+        Without `copy`, the tensors of `obj` are written as they are and must not
+        be modified until then, e.g. large memory-mapped tensors.
+        """
+        self._raise_error()
+        self.jobs.put((snapshot(obj) if copy else obj, path, list(copies)))
+
+    def wait(self):
+        """block until all the checkpoints are written"""
+        self.jobs.join()
+        self._raise_error()
+
+
+def mmap_load(path):
+    """
+    Load a checkpoint on cpu, memory-mapping the file when possible so that the
+    tensors are only read from disk when they are first accessed.
+    """
+    try:
+        return torch.load(path, map_location="cpu", mmap=True)
+    except (TypeError, RuntimeError):
+        # older torch, or a file not saved in the zipfile format
+        return torch.load(path, map_location="cpu")
+
+
+class _TensorRef(object):
+    """placeholder of a tensor in the structure broadcast with pickle"""
+
+    def __init__(self, index):
+        self.index = index
+
+
+def _extract_tensors(obj, tensors):
+    if torch.is_tensor(obj):
+        tensors.append(obj)
+        return _TensorRef(len(tensors) - 1)
+    if isinstance(obj, dict):
+        return type(obj)((k, _extract_tensors(v, tensors)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_extract_tensors(v, tensors) for v in obj)
+    return obj
+
+
+def _insert_tensors(obj, tensors):
+    if isinstance(obj, _TensorRef):
+        return tensors[obj.index]
+    if isinstance(obj, dict):
+        return type(obj)((k, _insert_tensors(v, tensors)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_insert_tensors(v, tensors) for v in obj)
+    return obj
+
+
+def _buckets(specs):
+    """
+    Group the tensors by dtype into buckets of at most BROADCAST_BUCKET_SIZE bytes
+    (or a single tensor if larger).
+    """
+    buckets = {}
+    for i, (shape, dtype) in enumerate(specs):
+        numel = 1
+        for d in shape:
+            numel *= d
+        size = numel * torch.empty((), dtype=dtype).element_size()
+        bucket = buckets.setdefault(dtype, [[[], 0]])[-1]
+        if bucket[0] and bucket[1] + size > BROADCAST_BUCKET_SIZE:
+            bucket = [[], 0]
+            buckets[dtype].append(bucket)
+        bucket[0].append((i, numel))
+        bucket[1] += size
+    return [(dtype, b[0]) for dtype in buckets for b in buckets[dtype]]
+
+
+def _node_group():
+    if dist.get_backend() == "nccl":
+        nmb_processes_per_node = torch.cuda.device_count()
+    else:
+        # processes on CPU, as launched by torchrun
+        nmb_processes_per_node = int(os.environ.get("LOCAL_WORLD_SIZE", 1))
+    nmb_processes_per_node = max(1, min(nmb_processes_per_node, dist.get_world_size()))
+    if nmb_processes_per_node not in _node_groups:
+        _node_groups[nmb_processes_per_node] = new_node_group(nmb_processes_per_node)
+    rank = dist.get_rank()
+    return _node_groups[nmb_processes_per_node], rank - rank % nmb_processes_per_node
+
+
+def load_checkpoint(path, map_location="cpu", read="single"):
+    """
+    Load a checkpoint in every process.
+    With read="all", every process reads the file.
+    With read="single", only rank 0 reads it and broadcasts it to all the processes,
+    with read="node" the first process of every node reads it and broadcasts it to
+    the processes of its node (nodes of torch.cuda.device_count() consecutive ranks,
+    or of LOCAL_WORLD_SIZE ones on CPU).
+    The reading process memory-maps the file, the tensors are packed into a few
+    buffers per dtype so that broadcasting takes a handful of collectives.
+    Every process must call this function with the same arguments.
+    """
+    if read == "all" or not (dist.is_available() and dist.is_initialized()):
+        return torch.load(path, map_location=map_location)
+    assert read in CHECKPOINT_READS, read
+
+    group, src = (None, 0) if read == "single" else _node_group()
+    if dist.get_world_size(group) == 1:
+        return torch.load(path, map_location=map_location)
+    is_src = dist.get_rank() == src
+    device = torch.device("cuda", torch.cuda.current_device()) \
+        if dist.get_backend(group) == "nccl" else torch.device("cpu")
+
+    # broadcast the structure of the checkpoint, without the tensors
+    tensors = []
+    header = [None]
+    if is_src:
+        skeleton = _extract_tensors(mmap_load(path), tensors)
+        header = [(skeleton, [(tuple(t.shape), t.dtype) for t in tensors])]
+    dist.broadcast_object_list(header, src=src, group=group)
+    skeleton, specs = header[0]
+
+    # broadcast the tensors, packed by dtype
+    out = [None] * len(specs)
+    for dtype, bucket in _buckets(specs):
+        numel = sum(n for _, n in bucket)
+        if is_src:
+            buffer = torch.cat([tensors[i].reshape(-1) for i, _ in bucket]).to(device)
+        else:
+            buffer = torch.empty(numel, dtype=dtype, device=device)
+        dist.broadcast(buffer, src=src, group=group)
+        buffer = buffer.to(map_location)
+        for (i, _), t in zip(bucket, buffer.split([n for _, n in bucket])):
+            out[i] = t.view(specs[i][0])
+    return _insert_tensors(skeleton, out)
+
+
+def shard_paths(dump_path, name, world_size):
+    """paths of the files `{name}{rank}.pth` saved by the processes of a job"""
+    return [os.path.join(dump_path, name + str(rank) + ".pth") for rank in range(world_size)]
+
+
+def saved_shards(dump_path, name):
+    """
+    paths of the files `{name}{rank}.pth` saved by the consecutive processes of
+    a job from rank 0, whatever their number
+    """
+    paths = []
+    while os.path.isfile(os.path.join(dump_path, name + str(len(paths)) + ".pth")):
+        paths.append(os.path.join(dump_path, name + str(len(paths)) + ".pth"))
+    return paths
+
+
+def load_rows(paths, get, start, length, dim=0):
+    """
+    Load the rows [start, start + length) along `dim` of the concatenation of the
+    tensors `get(checkpoint)` of the per-process files `paths`, wrapping around at
+    the end. The files of a job hold the same number of rows: the first one gives
+    the offsets of the others, and only the files holding rows of the range are
+    opened. They are memory-mapped so that only the rows needed are read.
+    Per-process states saved this way can be resharded when resuming with a
+    different number of processes.
+    """
+    tensors = {0: get(mmap_load(paths[0]))}
+    size = tensors[0].size(dim)
+    total = size * len(paths)
+    if start + length > total:
+        logger.warning("Rows {} to {} of the {} rows of {}... wrap around, {} of them are repeated".format(
+            start, start + length, total, paths[0], min(length, start + length - total)))
+
+    chunks = []
+    pos = start % total
+    while length > 0:
+        i = pos // size
+        if i not in tensors:
+            tensors[i] = get(mmap_load(paths[i]))
+            assert tensors[i].size(dim) == size, "{} does not hold {} rows".format(paths[i], size)
+        n = min(length, size * (i + 1) - pos)
+        chunks.append(tensors[i].narrow(dim, pos - size * i, n))
+        pos = (pos + n) % total
+        length -= n
+    return torch.cat(chunks, dim)
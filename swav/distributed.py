@@ -0,0 +1,183 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+
+from logging import getLogger
+
+import torch
+import torch.distributed as dist
+from torch.distributed.algorithms.ddp_comm_hooks import default_hooks, powerSGD_hook
+
+COMM_HOOKS = ["none", "fp16", "bf16", "powersgd"]
+
+logger = getLogger()
+
+
+class AllGather(torch.autograd.Function):
+    """
+    Gather a tensor from all the processes, stacked along a new first dimension.
+    In the backward pass, the gradients of the local slice are summed over all the
+    processes and multiplied by the world size, so that the gradient averaging done
+    by DistributedDataParallel on the replicated parameters gives the gradient of
+    the sum of the losses of all the processes.
+    """
+
+    @staticmethod
+    def forward(ctx, x, group):
+        ctx.group = group
+        ctx.rank = dist.get_rank(group)
+        ctx.world_size = dist.get_world_size(group)
+        out = [torch.empty_like(x) for _ in range(ctx.world_size)]
+        dist.all_gather(out, x.contiguous(), group=group)
+        return torch.stack(out)
+
+    @staticmethod
+    def backward(ctx, grad):
+        grad = grad.clone(memory_format=torch.contiguous_format)
+        dist.all_reduce(grad, group=ctx.group)
+        return grad[ctx.rank] * ctx.world_size, None
+
+
+class ShardedLogSumExp(torch.autograd.Function):
+    """
+    Row-wise logsumexp of a matrix whose columns are split across the processes of `group`.
+    """
+
+    @staticmethod
+    def forward(ctx, x, group):
+        ctx.group = group
+        x_max = x.detach().max(dim=1)[0]
+        dist.all_reduce(x_max, op=dist.ReduceOp.MAX, group=group)
+        sum_exp = torch.exp(x - x_max.unsqueeze(1)).sum(dim=1)
+        dist.all_reduce(sum_exp, group=group)
+        lse = x_max + torch.log(sum_exp)
+        ctx.save_for_backward(x, lse)
+        return lse
+
+    @staticmethod
+    def backward(ctx, grad):
+        x, lse = ctx.saved_tensors
+        # every shard contributes to the gradient of the shared logsumexp
+        grad = grad.clone(memory_format=torch.contiguous_format)
+        dist.all_reduce(grad, group=ctx.group)
+        return grad.unsqueeze(1) * torch.exp(x - lse.unsqueeze(1)), None
+
+
+def all_gather_with_grad(x, group=None):
+    return AllGather.apply(x, group)
+
+
+def sharded_log_softmax(x, group=None):
+    """
+    log-softmax along dim 1 when the columns of x are split across the processes of `group`.
+    Summing over the processes the losses computed on the local columns gives the loss
+    on the full matrix.
+    """
+    return x - ShardedLogSumExp.apply(x, group).unsqueeze(1)
+
+
+def group_device(group=None):
+    """device of the tensors exchanged in `group`: the current GPU with nccl, the host otherwise"""
+    if dist.get_backend(group) == "nccl":
+        return torch.device("cuda", torch.cuda.current_device())
+    return torch.device("cpu")
+
+
+def all_reduce_(tensor, group=None):
+    """in-place all-reduce of `tensor` in `group`, copied to the device of its backend if needed"""
+    staged = tensor.to(group_device(group))
+    dist.all_reduce(staged, group=group)
+    return tensor if staged is tensor else tensor.copy_(staged)
+
+
+def broadcast_(tensor, src, group=None):
+    """in-place broadcast of `tensor` from `src` in `group`, copied to the device of its backend if needed"""
+    staged = tensor.to(group_device(group))
+    dist.broadcast(staged, src, group=group)
+    return tensor if staged is tensor else tensor.copy_(staged)
+
+
+def new_node_group(nmb_processes_per_node):
+    """
+    Create the process groups of the consecutive ranks running on the same node
+    and return the one of the current process. Every process must call it.
+    """
+    rank = dist.get_rank()
+    world_size = dist.get_world_size()
+    node_group = None
+    for start in range(0, world_size, nmb_processes_per_node):
+        ranks = list(range(start, min(start + nmb_processes_per_node, world_size)))
+        group = dist.new_group(ranks)
+        if rank in ranks:
+            node_group = group
+    return node_group
+
+
+def _timed_hook(hook, timer):
+    """wrap a communication hook to time the all-reduce of the gradient buckets"""
+
+    def timed_hook(state, bucket):
+        start = timer.mark()
+
+        def done(fut):
+            timer.record("grad_sync", start, timer.mark(), overlap=True)
+            return fut.value()
+
+        return hook(state, bucket).then(done)
+
+    return timed_hook
+
+
+class CommHook(object):
+    """
+    Communication hook of a DistributedDataParallel model compressing the gradients
+    before they are all-reduced: cast to fp16 / bf16, or PowerSGD low-rank
+    approximation with error feedback.
+    Only the configuration and the PowerSGD iteration are checkpointed, the error
+    feedback of every process starts again from zero when resuming.
+    With an enabled `timer` (swav.profiler.StepTimer), the communication of the
+    gradients is timed as the "grad_sync" region, using the plain all-reduce hook
+    when no compression is selected.
+    """
+
+    def __init__(self, model, name="none", powersgd_rank=1, powersgd_start_iter=1000, timer=None):
+        assert name in COMM_HOOKS, "unknown communication hook {}".format(name)
+        self.name = name
+        self.state = None
+        hook = None
+        if name == "fp16":
+            hook = default_hooks.fp16_compress_hook
+        elif name == "bf16":
+            hook = default_hooks.bf16_compress_hook
+        elif name == "powersgd":
+            self.state = powerSGD_hook.PowerSGDState(
+                process_group=None,
+                matrix_approximation_rank=powersgd_rank,
+                start_powerSGD_iter=powersgd_start_iter,
+            )
+            hook = powerSGD_hook.powerSGD_hook
+        if timer is not None and timer.enabled:
+            hook = _timed_hook(hook or default_hooks.allreduce_hook, timer)
+        if hook is not None:
+            model.register_comm_hook(self.state, hook)
+
+    def __repr__(self):
+        if self.state is not None:
+            return "{}(rank={}, start_iter={})".format(
+                self.name, self.state.matrix_approximation_rank, self.state.start_powerSGD_iter)
+        return self.name
+
+    def state_dict(self):
+        state_dict = {"name": self.name}
+        if self.state is not None:
+            state_dict["iter"] = self.state.iter
+        return state_dict
+
+    def load_state_dict(self, state_dict):
+        if state_dict["name"] != self.name:
+            logger.warning("Communication hook changed from {} to {}".format(state_dict["name"], self.name))
+        elif self.state is not None:
+            self.state.iter = state_dict["iter"]
@@ -0,0 +1,157 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+
+import torch
+import torch.distributed as dist
+
+from swav.distributed import all_reduce_, broadcast_, group_device
+
+
+def _chunks(embeddings, chunk_size, device, dtype):
+    """
+    Consecutive chunks of `chunk_size` embeddings (all at once if 0), moved to
+    `device` and cast to `dtype`, with their start and end.
+    """
+    n = embeddings.size(0)
+    chunk_size = chunk_size if chunk_size > 0 else max(n, 1)
+    for start in range(0, n, chunk_size):
+        end = min(start + chunk_size, n)
+        yield start, end, embeddings[start:end].to(device, dtype, non_blocking=True)
+
+
+def cluster_sums(embeddings, assignments, nmb_clusters, chunk_size=0):
+    """
+    M step of k-means: sum of the embeddings (N x D) and number of elements
+    of every cluster, computed in fp32 on the device of the assignments with
+    scatter-adds and one bincount. The embeddings can be stored in lower
+    precision or in host memory, they are transferred by chunks of `chunk_size`.
+    """
+    emb_sums = torch.zeros(
+        nmb_clusters, embeddings.size(1), dtype=torch.float32, device=assignments.device
+    )
+    for start, end, chunk in _chunks(embeddings, chunk_size, assignments.device, torch.float32):
+        emb_sums.index_add_(0, assignments[start:end], chunk)
+    counts = torch.bincount(assignments, minlength=nmb_clusters)
+    return emb_sums, counts
+
+
+def nearest_centroids(embeddings, centroids, chunk_size=0, return_scores=False):
+    """
+    E step of k-means: index of the centroid with the highest dot product with
+    every embedding (N x D), and optionally this score, on the device and in
+    the precision of the centroids.
+    The embeddings are processed by chunks of `chunk_size` (all at once if 0),
+    so that at most chunk_size x K scores are materialized.
+    """
+    n = embeddings.size(0)
+    assignments = torch.empty(n, dtype=torch.long, device=centroids.device)
+    scores = torch.empty(n, dtype=centroids.dtype, device=centroids.device)
+    for start, end, chunk in _chunks(embeddings, chunk_size, centroids.device, centroids.dtype):
+        torch.max(
+            torch.mm(chunk, centroids.t()),
+            dim=1,
+            out=(scores[start:end], assignments[start:end]),
+        )
+    if return_scores:
+        return assignments, scores
+    return assignments
+
+
+def _gather_rows(rows, group=None):
+    """concatenation of the rows (n x D, n can differ) of all the processes of `group`"""
+    comm_device = group_device(group)
+    world_size = dist.get_world_size(group)
+    sizes = [torch.empty(1, dtype=torch.long, device=comm_device) for _ in range(world_size)]
+    dist.all_gather(sizes, torch.tensor([len(rows)], device=comm_device), group=group)
+    sizes = [size.item() for size in sizes]
+    padded = torch.zeros(max(max(sizes), 1), rows.size(1), dtype=rows.dtype, device=comm_device)
+    padded[:len(rows)] = rows
+    gathered = [torch.empty_like(padded) for _ in range(world_size)]
+    dist.all_gather(gathered, padded, group=group)
+    return torch.cat([g[:size] for g, size in zip(gathered, sizes)]).to(rows.device)
+
+
+def _weighted_kmeans_plus_plus(points, weights, nmb_clusters, generator):
+    """k-means++ seeding over `points` counted `weights` times, without synchronizing with the device"""
+    centroids = torch.empty(nmb_clusters, points.size(1), dtype=points.dtype, device=points.device)
+    min_dists = torch.full((len(points),), 4., dtype=points.dtype, device=points.device)
+    idx = torch.multinomial(weights, 1, generator=generator)
+    for k in range(nmb_clusters):
+        centroids[k] = points[idx].squeeze(0)
+        # squared distance between unit vectors
+        dists = (2 - 2 * torch.mv(points, centroids[k])).clamp_min_(0)
+        torch.minimum(min_dists, dists, out=min_dists)
+        # (tiny floor, in case fewer distinct points than clusters remain)
+        idx = torch.multinomial(weights * min_dists + 1e-20, 1, generator=generator)
+    return centroids
+
+
+def kmeans_plus_plus(embeddings, nmb_clusters, seed=0, group=None, chunk_size=0, device=None,
+                     rounds=5, oversampling=2.):
+    """
+    Distributed k-means++ seeding over the L2-normalized embeddings (N x D)
+    of all the processes, every one of them must call it. `group` must contain
+    all the processes.
+    It uses the oversampling of k-means|| (scalable k-means++), so that it needs
+    a few collectives instead of a few per centroid: starting from one random
+    embedding, each of the `rounds` rounds samples every embedding with a
+    probability proportional to its squared distance to the closest candidate,
+    `oversampling` x `nmb_clusters` of them in expectation. The candidates of
+    all the processes are gathered and weighted by the number of embeddings
+    they are the closest to, and rank 0 runs k-means++ over them locally.
+    The distances are computed in fp32 on `device` (the one of the embeddings
+    by default), by chunks of `chunk_size` embeddings.
+    """
+    n, d = embeddings.shape
+    device = device or embeddings.device
+    rank, world_size = dist.get_rank(group), dist.get_world_size(group)
+    generator = torch.Generator(device=device).manual_seed(seed * world_size + rank)
+    min_dists = torch.empty(n, dtype=torch.float32, device=device)
+
+    def scaled_chunk_size(nmb_candidates):
+        # as many scores at once as the E step of k-means
+        return max(1, chunk_size * nmb_clusters // nmb_candidates) if chunk_size > 0 else 0
+
+    def add_candidates(new, first=False):
+        for start, end, chunk in _chunks(embeddings, scaled_chunk_size(len(new)), device, torch.float32):
+            # squared distance between unit vectors
+            dists = (2 - 2 * torch.mm(chunk, new.t())).clamp_min_(0).min(dim=1)[0]
+            if first:
+                min_dists[start:end] = dists
+            else:
+                torch.minimum(min_dists[start:end], dists, out=min_dists[start:end])
+
+    # first candidate, drawn by rank 0
+    candidates = torch.empty(1, d, dtype=torch.float32, device=device)
+    if rank == 0:
+        first = torch.randint(n, (1,), generator=torch.Generator().manual_seed(seed))
+        candidates = embeddings[first].to(device, torch.float32)
+    broadcast_(candidates, 0, group=group)
+    add_candidates(candidates, first=True)
+
+    # oversampling rounds
+    for _ in range(rounds):
+        cost = all_reduce_(min_dists.sum().double().view(1), group=group)
+        probs = (oversampling * nmb_clusters / cost.clamp_min(1e-12)).float() * min_dists
+        selected = torch.nonzero(torch.rand(n, generator=generator, device=device) < probs).flatten()
+        new = _gather_rows(embeddings[selected.to(embeddings.device)].to(device, torch.float32), group)
+        if len(new) > 0:
+            add_candidates(new)
+            candidates = torch.cat((candidates, new))
+    assert len(candidates) >= nmb_clusters, "please reduce the number of centroids"
+
+    # weight the candidates by the number of embeddings they are the closest to
+    weights = torch.bincount(
+        nearest_centroids(embeddings, candidates, scaled_chunk_size(len(candidates))), minlength=len(candidates),
+    ).float()
+    all_reduce_(weights, group=group)
+
+    centroids = torch.empty(nmb_clusters, d, dtype=torch.float32, device=device)
+    if rank == 0:
+        centroids = _weighted_kmeans_plus_plus(candidates, weights, nmb_clusters, generator)
+    broadcast_(centroids, 0, group=group)
+    return centroids
@@ -5,7 +5,9 @@
 # LICENSE file in the root directory of this source tree.
 #
 
+import atexit
 import os
+import json
 import logging
 import time
 from datetime import timedelta
@@ -68,27 +70,81 @@ def create_logger(filepath, rank):
     return logger
 
 
-class PD_Stats(object):
+def _to_json(value):
+    # numpy and torch scalars / arrays
+    if hasattr(value, "tolist"):
+        return value.tolist()
+    raise TypeError("{} is not JSON serializable".format(type(value).__name__))
+
+
+def read_stats(path):
+    """
+    Read the statistics written by JSONL_Stats in a pandas DataFrame.
+    A line truncated by a crash is ignored.
+    """
+    rows = []
+    with open(path) as f:
+        for line in f:
+            try:
+                rows.append(json.loads(line))
+            except ValueError:
+                continue
+    return pd.DataFrame(rows)
+
+
+def _drop_partial_line(path):
+    # remove the end of a line interrupted by a crash before appending to the file
+    with open(path, "rb+") as f:
+        data = f.read()
+        if data and not data.endswith(b"\n"):
+            f.truncate(data.rfind(b"\n") + 1)
+
+
+class JSONL_Stats(object):
     """
-    Log stuff with pandas library
+    Append-only statistics, one JSON line per row.
+    Rows are buffered and written every `flush_freq` rows or `flush_secs`
+    seconds, when updated with `save=True`, by `flush` (e.g. at the end of an
+    epoch) and at exit. Every write appends complete lines, so that the file is
+    readable after a crash.
+    Statistics pickled in a DataFrame at `path` with a .pkl extension by previous
+    versions are converted when resuming.
     """
 
-    def __init__(self, path, columns):
+    def __init__(self, path, columns, flush_freq=100, flush_secs=30):
         self.path = path
+        self.columns = list(columns)
+        self.flush_freq = flush_freq
+        self.flush_secs = flush_secs
+        self.buffer = []
+        self.last_flush = time.time()
+        atexit.register(self.flush)
 
         # reload path stats
         if os.path.isfile(self.path):
-            self.stats = pd.read_pickle(self.path)
-
+            _drop_partial_line(self.path)
+            stats = read_stats(self.path)
             # check that columns are the same
-            assert list(self.stats.columns) == list(columns)
-
+            assert stats.empty or list(stats.columns) == self.columns
         else:
-            self.stats = pd.DataFrame(columns=columns)
+            pkl_path = os.path.splitext(self.path)[0] + ".pkl"
+            if os.path.isfile(pkl_path):
+                stats = pd.read_pickle(pkl_path)
+                assert list(stats.columns) == self.columns
+                for row in stats.itertuples(index=False):
+                    self.update(list(row))
+                self.flush()
 
-    def update(self, row, save=True):
-        self.stats.loc[len(self.stats.index)] = row
+    def update(self, row, save=False):
+        self.buffer.append(json.dumps(dict(zip(self.columns, row)), default=_to_json) + "\n")
 
         # save the statistics
-        if save:
-            self.stats.to_pickle(self.path)
+        if save or len(self.buffer) >= self.flush_freq or time.time() - self.last_flush >= self.flush_secs:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            with open(self.path, "a") as f:
+                f.write("".join(self.buffer))
+            self.buffer = []
+        self.last_flush = time.time()
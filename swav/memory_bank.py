@@ -0,0 +1,139 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+
+import math
+
+import torch
+import torch.distributed as dist
+
+MEMORY_DTYPES = {"fp32": torch.float32, "fp16": torch.float16, "bf16": torch.bfloat16}
+MEMORY_LOCATIONS = ["gpu", "cpu", "mmap"]
+
+
+def empty_memory(shape, dtype="fp32", location="gpu", path=None, device="cuda"):
+    """
+    Zero-initialized embeddings of a memory bank, stored in `dtype` on the
+    training `device` ("gpu"), in pinned host memory ("cpu") or in the
+    memory-mapped file `path` ("mmap").
+    """
+    dtype = MEMORY_DTYPES[dtype]
+    if location == "gpu":
+        return torch.zeros(shape, dtype=dtype, device=device)
+    if location == "cpu":
+        return torch.zeros(shape, dtype=dtype, pin_memory=torch.cuda.is_available())
+    memory = torch.from_file(path, shared=True, size=math.prod(shape), dtype=dtype).view(shape)
+    return memory.zero_()
+
+
+def snapshot_memory(memory, location="gpu", path=None, chunk_size=65536):
+    """
+    Copy of the embeddings of a memory bank (crops x N x D). A memory-mapped
+    one is copied by chunks of `chunk_size` embeddings to the memory-mapped
+    file `path`, so that it is never loaded entirely in RAM. Otherwise the copy
+    is in the same memory, e.g. it doubles the GPU memory of the memory bank.
+    """
+    if location != "mmap":
+        return memory.clone()
+    copy = torch.from_file(path, shared=True, size=memory.numel(), dtype=memory.dtype).view(memory.shape)
+    for start in range(0, memory.size(1), chunk_size):
+        copy[:, start: start + chunk_size] = memory[:, start: start + chunk_size]
+    return copy
+
+
+def _assignment_dtype(nmb_prototypes):
+    return torch.int16 if max(nmb_prototypes) < torch.iinfo(torch.int16).max else torch.int32
+
+
+def _exchange(values, dest, group=None):
+    """
+    Send the rows of `values` to the processes `dest` with one all-to-all.
+    Return the rows received, ordered by source process, the number of rows
+    received from every process, and the order and counts of the rows sent,
+    to send replies back.
+    """
+    world_size = dist.get_world_size(group)
+    order = torch.argsort(dest)
+    send_counts = torch.bincount(dest, minlength=world_size)
+    recv_counts = torch.empty_like(send_counts)
+    dist.all_to_all_single(recv_counts, send_counts, group=group)
+    send_counts, recv_counts = send_counts.tolist(), recv_counts.tolist()
+    received = values.new_empty((sum(recv_counts),) + values.shape[1:])
+    dist.all_to_all_single(received, values[order].contiguous(), recv_counts, send_counts, group=group)
+    return received, recv_counts, order, send_counts
+
+
+class AssignmentTable(object):
+    """
+    Cluster assignments of the samples of the dataset for every head, kept on
+    the device in int16 (int32 for more than 32767 prototypes), -100 when unknown.
+
+    Built from the assignments of the memory banks of all the processes
+    (`local_index`: N, `local_assignments`: heads x N). If `sampler_indices`
+    (the indices yielded by the sampler of this process for the epoch, in order)
+    are given, each process only keeps the assignments of these samples, in the
+    same order, so that the table is split across the processes. Otherwise
+    every process keeps the assignments of the whole dataset.
+    """
+
+    def __init__(self, local_index, local_assignments, size_dataset, nmb_prototypes,
+                 sampler_indices=None, group=None):
+        self.dtype = _assignment_dtype(nmb_prototypes)
+        self.sharded = sampler_indices is not None
+        if self.sharded:
+            self.table = self._sharded(local_index, local_assignments, size_dataset, sampler_indices, group)
+        else:
+            self.table = self._dense(local_index, local_assignments, size_dataset, group)
+
+    def _dense(self, local_index, local_assignments, size_dataset, group):
+        # gather the indexes, shared by all the heads, and the assignments of all the heads at once
+        world_size = dist.get_world_size(group)
+        local_all = torch.cat((local_index.view(1, -1), local_assignments))
+        gathered = torch.empty((world_size,) + local_all.shape, dtype=local_all.dtype, device=local_all.device)
+        dist.all_gather(list(gathered.unbind(0)), local_all, group=group)
+        indexes_all = gathered[:, 0].reshape(-1)
+        assignments_all = gathered[:, 1:].transpose(0, 1).reshape(local_assignments.size(0), -1)
+
+        table = torch.full(
+            (local_assignments.size(0), size_dataset), -100, dtype=self.dtype, device=local_assignments.device
+        )
+        table[:, indexes_all] = assignments_all.to(self.dtype)
+        return table
+
+    def _sharded(self, local_index, local_assignments, size_dataset, sampler_indices, group):
+        world_size = dist.get_world_size(group)
+        nmb_heads = local_assignments.size(0)
+        device = local_assignments.device
+
+        # the assignments of sample i are first sent to process i % world_size
+        # (exchanged in int32, the collectives do not support int16)
+        rows = torch.cat((local_index.view(-1, 1), local_assignments.t()), dim=1)
+        rows, _, _, _ = _exchange(rows, local_index % world_size, group)
+        directory = torch.full(
+            (-(-size_dataset // world_size), nmb_heads), -100, dtype=torch.int32, device=device
+        )
+        directory[rows[:, 0] // world_size] = rows[:, 1:].to(torch.int32)
+
+        # which answers the requests of the processes needing them
+        sampler_indices = torch.as_tensor(sampler_indices, dtype=torch.long, device=device)
+        requests, recv_counts, order, send_counts = _exchange(
+            sampler_indices, sampler_indices % world_size, group)
+        answers = directory[requests // world_size]
+        replies = answers.new_empty((len(sampler_indices), nmb_heads))
+        dist.all_to_all_single(replies, answers, send_counts, recv_counts, group=group)
+
+        table = torch.empty((nmb_heads, len(sampler_indices)), dtype=self.dtype, device=device)
+        table[:, order] = replies.t().to(self.dtype)
+        return table
+
+    def targets(self, idx, start):
+        """
+        Assignments (heads x batch size) of the samples `idx` of the batch
+        starting at position `start` of the epoch.
+        """
+        if self.sharded:
+            return self.table[:, start: start + len(idx)].long()
+        return self.table[:, idx.to(self.table.device, non_blocking=True)].long()
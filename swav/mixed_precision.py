@@ -0,0 +1,53 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+
+import torch
+
+PRECISIONS = {"fp32": None, "fp16": torch.float16, "bf16": torch.bfloat16}
+
+
+def _grad_scaler(device_type, enabled):
+    # device generic scaler only available from torch 2.3
+    if hasattr(torch.amp, "GradScaler"):
+        return torch.amp.GradScaler(device_type, enabled=enabled)
+    return torch.cuda.amp.GradScaler(enabled=enabled and device_type == "cuda")
+
+
+class MixedPrecision(object):
+    """
+    Mixed precision training with torch autocast.
+    fp16 scales the loss to avoid gradient underflows, bf16 does not need to
+    and can also be used on CPU. With fp32, every method is a no-op.
+    """
+
+    def __init__(self, precision="fp32", device_type="cuda"):
+        assert precision in PRECISIONS, "unknown precision {}".format(precision)
+        self.precision = precision
+        self.dtype = PRECISIONS[precision]
+        self.device_type = device_type
+        self.scaler = _grad_scaler(device_type, precision == "fp16")
+
+    @property
+    def enabled(self):
+        return self.dtype is not None
+
+    def autocast(self):
+        return torch.autocast(self.device_type, dtype=self.dtype, enabled=self.enabled)
+
+    def backward(self, loss):
+        self.scaler.scale(loss).backward()
+
+    def step(self, optimizer):
+        """optimizer step, skipped if the gradients overflowed"""
+        self.scaler.step(optimizer)
+        self.scaler.update()
+
+    def state_dict(self):
+        return self.scaler.state_dict()
+
+    def load_state_dict(self, state_dict):
+        self.scaler.load_state_dict(state_dict)
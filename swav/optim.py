@@ -0,0 +1,121 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+
+import torch
+from torch.distributed.optim import ZeroRedundancyOptimizer
+
+
+class LARC(object):
+    """
+    Layer-wise adaptive rate control around another optimizer, with the same
+    interface and checkpoint format as apex.parallel.LARC.
+
+    The local learning rate of every parameter is
+        trust_coefficient * ||w|| / (||g|| + weight_decay * ||w|| + eps)
+    With `clip`, the learning rate of the group is clipped to it (LARC),
+    otherwise it scales the learning rate of the group (LARS).
+    The norms and the updates of the gradients of each parameter group are
+    computed with batched foreach ops.
+    """
+
+    def __init__(self, optimizer, trust_coefficient=0.02, clip=True, eps=1e-8):
+        self.optim = optimizer
+        self.trust_coefficient = trust_coefficient
+        self.eps = eps
+        self.clip = clip
+
+    def __getstate__(self):
+        return self.optim.__getstate__()
+
+    def __setstate__(self, state):
+        self.optim.__setstate__(state)
+
+    @property
+    def state(self):
+        return self.optim.state
+
+    def __repr__(self):
+        return self.optim.__repr__()
+
+    @property
+    def param_groups(self):
+        return self.optim.param_groups
+
+    @param_groups.setter
+    def param_groups(self, value):
+        self.optim.param_groups = value
+
+    def state_dict(self):
+        return self.optim.state_dict()
+
+    def load_state_dict(self, state_dict):
+        self.optim.load_state_dict(state_dict)
+
+    def zero_grad(self, *args, **kwargs):
+        self.optim.zero_grad(*args, **kwargs)
+
+    def add_param_group(self, param_group):
+        self.optim.add_param_group(param_group)
+
+    def step(self, *args, **kwargs):
+        with torch.no_grad():
+            weight_decays = []
+            for group in self.optim.param_groups:
+                # absorb weight decay control from the wrapped optimizer
+                weight_decay = group.get("weight_decay", 0)
+                weight_decays.append(weight_decay)
+                group["weight_decay"] = 0
+
+                params = [p for p in group["params"] if p.grad is not None]
+                if len(params) == 0:
+                    continue
+                grads = [p.grad for p in params]
+                param_norms = torch.stack(torch._foreach_norm(params))
+                grad_norms = torch.stack(torch._foreach_norm(grads))
+
+                # parameters or gradients with a zero norm are left untouched
+                mask = (param_norms != 0) & (grad_norms != 0)
+                adaptive_lr = self.trust_coefficient * param_norms / (
+                    grad_norms + param_norms * weight_decay + self.eps)
+                if self.clip:
+                    adaptive_lr = torch.clamp(adaptive_lr / group["lr"], max=1)
+                adaptive_lr = torch.where(mask, adaptive_lr, torch.ones_like(adaptive_lr))
+
+                if weight_decay != 0:
+                    if bool(mask.all()):
+                        torch._foreach_add_(grads, params, alpha=weight_decay)
+                    else:
+                        decay = mask.to(param_norms.dtype) * weight_decay
+                        torch._foreach_add_(grads, torch._foreach_mul(params, list(decay.unbind(0))))
+                torch._foreach_mul_(grads, list(adaptive_lr.unbind(0)))
+
+        self.optim.step(*args, **kwargs)
+        # return weight decay control to the wrapped optimizer
+        for i, group in enumerate(self.optim.param_groups):
+            group["weight_decay"] = weight_decays[i]
+
+
+def build_optimizer(optimizer_class, params, zero=False, **defaults):
+    """
+    Instantiate `optimizer_class` over `params`. With `zero`, the optimizer state is
+    partitioned across the processes (ZeRO stage 1): every process only updates its
+    shard of the parameters and broadcasts them to the others after the step.
+    """
+    if zero:
+        return ZeroRedundancyOptimizer(params, optimizer_class=optimizer_class, **defaults)
+    return optimizer_class(params, **defaults)
+
+
+def consolidate_state_dict(optimizer, to=0):
+    """
+    Gather on rank `to` the state of an optimizer partitioned across the processes,
+    this is a no-op for the other optimizers. Must be called by all the processes
+    before `optimizer.state_dict()` is saved.
+    """
+    optim = getattr(optimizer, "optim", optimizer)
+    if isinstance(optim, ZeroRedundancyOptimizer):
+        optim.consolidate_state_dict(to=to)
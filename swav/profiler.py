@@ -0,0 +1,320 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+
+from collections import defaultdict, deque
+import contextlib
+from logging import getLogger
+import os
+import threading
+import time
+
+import torch
+import torch.distributed as dist
+from torch.profiler import profile, record_function, ProfilerActivity
+
+from swav.logger import JSONL_Stats
+
+logger = getLogger()
+
+# timer of the named regions, None when the training is not instrumented
+_active = None
+_null_region = contextlib.nullcontext()
+
+
+def timed(name):
+    """
+    Time the region `name` of the current step with the active StepTimer.
+    Does nothing if no timer is active, so that the models and the Sinkhorn-Knopp
+    solvers can be instrumented unconditionally, or outside of the thread which
+    activated it (e.g. background clustering).
+    """
+    if _active is None or threading.get_ident() != _active.thread:
+        return _null_region
+    return _active.region(name)
+
+
+def parse_steps(steps):
+    """parse a step range "start:end" of the command line, "" for none"""
+    if not steps:
+        return None
+    start, end = steps.split(":")
+    assert int(start) < int(end), "empty step range {}".format(steps)
+    return int(start), int(end)
+
+
+class StepTimer(object):
+    """
+    Breakdown of the training step into named regions.
+    On GPU, regions are delimited by CUDA events, so that timing does not
+    synchronize the host with the device. The events of a step are resolved at
+    a later step, once the device has completed them, and the remaining ones
+    at the end of the epoch (`summary`).
+    Regions appear in the torch profiler traces under the same names.
+
+    Durations are summed over the regions of the same name in a step, except for
+    the `overlap` ones (e.g. the gradient buckets all-reduced during the backward)
+    which are measured from the first start to the last end.
+    Per-step durations are appended to `csv_path` as `step,region,milliseconds`
+    and their averages are written to `tb_writer` every `log_freq` steps.
+    Between the steps `profile_steps` = (start, end), the torch profiler is run
+    and its Chrome trace is exported to `trace_dir`.
+    Regions are timed on the host when training on CPU (`device`).
+    """
+
+    def __init__(self, enabled=False, csv_path=None, tb_writer=None, log_freq=50,
+                 profile_steps=None, trace_dir=".", rank=0, device=None):
+        self.enabled = enabled or profile_steps is not None
+        self.cuda = torch.cuda.is_available() if device is None else torch.device(device).type == "cuda"
+        self.csv_file = open(csv_path, "a") if enabled and csv_path else None
+        self.tb_writer = tb_writer if enabled else None
+        self.log_freq = log_freq
+        self.profile_steps = profile_steps
+        self.trace_dir = trace_dir
+        self.rank = rank
+        self.profiler = None
+
+        self.pending = []
+        self.host = defaultdict(float)
+        self.queued = deque()
+        self.window = defaultdict(float)
+        self.window_steps = 0
+        self.totals = defaultdict(float)
+        self.total_steps = 0
+
+    def activate(self):
+        """make this timer the one used by `timed`"""
+        global _active
+        _active = self if self.enabled else None
+        self.thread = threading.get_ident()
+        return self
+
+    def mark(self):
+        """current time, as a recorded CUDA event on GPU"""
+        if self.cuda:
+            event = torch.cuda.Event(enable_timing=True)
+            event.record()
+            return event
+        return time.perf_counter()
+
+    def _elapsed(self, start, end):
+        if self.cuda:
+            return start.elapsed_time(end)
+        return 1000 * (end - start)
+
+    def record(self, name, start, end, overlap=False):
+        """add a region delimited by two marks"""
+        self.pending.append((name, start, end, overlap))
+
+    def add(self, name, seconds):
+        """add a region measured on the host, e.g. the time waiting for data"""
+        if self.enabled:
+            self.host[name] += 1000 * seconds
+
+    @contextlib.contextmanager
+    def region(self, name):
+        with record_function(name):
+            start = self.mark()
+            yield
+            self.record(name, start, self.mark())
+
+    def _durations(self, pending, durations):
+        spans = {}
+        for name, start, end, overlap in pending:
+            if overlap:
+                first, last = spans.get(name, (start, end))
+                if self._elapsed(start, first) > 0:
+                    first = start
+                if self._elapsed(last, end) > 0:
+                    last = end
+                spans[name] = (first, last)
+            else:
+                durations[name] += self._elapsed(start, end)
+        for name, (first, last) in spans.items():
+            durations[name] += self._elapsed(first, last)
+        return durations
+
+    def _ready(self, pending):
+        return not self.cuda or all(start.query() and end.query() for _, start, end, _ in pending)
+
+    def _drain(self, wait=False):
+        """resolve the queued steps whose events are completed, or all of them if `wait`"""
+        if wait and self.cuda and self.queued:
+            torch.cuda.synchronize()
+        while self.queued and (wait or self._ready(self.queued[0][1])):
+            iteration, pending, host, is_step = self.queued.popleft()
+            durations = self._durations(pending, host)
+            for name, ms in durations.items():
+                self.window[name] += ms
+                self.totals[name] += ms
+            if self.csv_file is not None:
+                for name, ms in durations.items():
+                    self.csv_file.write("{},{},{:.3f}\n".format(iteration, name, ms))
+            if not is_step:
+                continue
+            self.window_steps += 1
+            self.total_steps += 1
+            if self.window_steps == self.log_freq:
+                if self.tb_writer is not None:
+                    for name, ms in self.window.items():
+                        self.tb_writer.add_scalar("Time/" + name, ms / self.window_steps, iteration)
+                self.window = defaultdict(float)
+                self.window_steps = 0
+
+    def _accumulate(self, iteration, is_step):
+        self.queued.append((iteration, self.pending, self.host, is_step))
+        self.pending, self.host = [], defaultdict(float)
+        self._drain()
+
+    def phase(self, iteration):
+        """end of a phase outside of the training steps, e.g. the clustering"""
+        if self.enabled:
+            self._accumulate(iteration, False)
+
+    def step(self, iteration):
+        """end of the training step `iteration`"""
+        if not self.enabled:
+            return
+        self._accumulate(iteration, True)
+        self._profile(iteration + 1)
+
+    def _profile(self, next_iteration):
+        if self.profile_steps is None:
+            return
+        start, end = self.profile_steps
+        if next_iteration == start:
+            activities = [ProfilerActivity.CPU]
+            if self.cuda:
+                activities.append(ProfilerActivity.CUDA)
+            self.profiler = profile(activities=activities)
+            self.profiler.start()
+        elif next_iteration == end and self.profiler is not None:
+            self.profiler.stop()
+            path = os.path.join(self.trace_dir, "trace{}-{}-{}.json".format(self.rank, start, end))
+            self.profiler.export_chrome_trace(path)
+            logger.info("Exported profiler trace of steps {} to {}: {}".format(start, end, path))
+            self.profiler = None
+
+    def summary(self):
+        """
+        Average duration in ms of every region per step since the last call,
+        the phases outside of the training steps are averaged over the same steps.
+        Waits for the device to complete the steps not resolved yet.
+        """
+        self._drain(wait=True)
+        steps = max(self.total_steps, 1)
+        summary = {name: ms / steps for name, ms in self.totals.items()}
+        self.totals = defaultdict(float)
+        self.total_steps = 0
+        if self.csv_file is not None:
+            self.csv_file.flush()
+        return summary
+
+    def log_summary(self, title="Step time breakdown"):
+        if not self.enabled:
+            return
+        summary = self.summary()
+        logger.info("{} (ms/step): {}".format(
+            title, ", ".join("{} {:.2f}".format(k, v) for k, v in sorted(summary.items()))))
+
+
+def skew_outliers(values, threshold=3., min_delta=0.01, low=False):
+    """
+    Indices of the outliers of `values` (one per process): more than `threshold`
+    robust standard deviations (1.4826 x median absolute deviation) and `min_delta`
+    above the median, or below it if `low`.
+    """
+    median = values.median()
+    deviations = median - values if low else values - median
+    scale = 1.4826 * (values - median).abs().median()
+    return torch.nonzero(deviations > max(threshold * scale.item(), min_delta)).flatten().tolist()
+
+
+class StragglerMonitor(object):
+    """
+    Cross-process skew detection.
+    Every `freq` steps, the processes exchange a summary of their last steps:
+    mean and 90th percentile of the step time and of the time waiting for data,
+    and the time they waited for the others in this exchange at the previous
+    report. Rank 0 logs the processes whose step or data time is abnormally high
+    and the ones which never wait for the others, and appends the summary of
+    the skew to `stats_path`.
+    """
+
+    FIELDS = ["step_time", "step_time_p90", "data_time", "data_time_p90", "sync_wait"]
+
+    def __init__(self, freq=100, threshold=3., stats_path=None, rank=0):
+        self.freq = freq
+        self.threshold = threshold
+        self.rank = rank
+        self.step_times = []
+        self.data_times = []
+        self.sync_wait = 0.
+        self.stats = None
+        if freq > 0 and rank == 0 and stats_path is not None:
+            self.stats = JSONL_Stats(stats_path, [
+                "iteration", "step_time", "step_time_max", "data_time", "data_time_max", "stragglers",
+            ])
+
+    def update(self, iteration, step_time, data_time):
+        """add the host measured times (in seconds) of the training step `iteration`"""
+        if self.freq <= 0:
+            return
+        self.step_times.append(step_time)
+        self.data_times.append(data_time)
+        if len(self.step_times) == self.freq:
+            self._report(iteration)
+
+    def _report(self, iteration):
+        step_times = torch.tensor(self.step_times, dtype=torch.float64)
+        data_times = torch.tensor(self.data_times, dtype=torch.float64)
+        self.step_times, self.data_times = [], []
+        cuda = dist.get_backend() == "nccl"
+        summary = torch.tensor([
+            step_times.mean(),
+            step_times.quantile(0.9),
+            data_times.mean(),
+            data_times.quantile(0.9),
+            self.sync_wait,
+        ], dtype=torch.float64, device="cuda" if cuda else "cpu")
+
+        # time waiting for the other processes, once the local work is done
+        if cuda:
+            torch.cuda.synchronize()
+        start = time.time()
+        summaries = [torch.empty_like(summary) for _ in range(dist.get_world_size())]
+        dist.all_gather(summaries, summary)
+        summaries = torch.stack(summaries).cpu()
+        self.sync_wait = time.time() - start
+
+        if self.rank == 0:
+            self._log(iteration, summaries)
+
+    def _log(self, iteration, summaries):
+        stragglers = defaultdict(list)
+        for i, field in enumerate(self.FIELDS):
+            low = field == "sync_wait"
+            for rank in skew_outliers(summaries[:, i], self.threshold, low=low):
+                stragglers[rank].append(field)
+        for rank, fields in sorted(stragglers.items()):
+            logger.warning(
+                "Straggler at iteration {}: rank {} ({}), step time {:.3f}s (median {:.3f}s), "
+                "data time {:.3f}s (median {:.3f}s), waited {:.3f}s for the others (median {:.3f}s)".format(
+                    iteration, rank, ", ".join(fields),
+                    summaries[rank, 0], summaries[:, 0].median(),
+                    summaries[rank, 2], summaries[:, 2].median(),
+                    summaries[rank, 4], summaries[:, 4].median(),
+                )
+            )
+        if self.stats is not None:
+            self.stats.update([
+                iteration,
+                summaries[:, 0].median().item(),
+                summaries[:, 0].max().item(),
+                summaries[:, 2].median().item(),
+                summaries[:, 2].max().item(),
+                " ".join("{}:{}".format(rank, ",".join(fields)) for rank, fields in sorted(stragglers.items())),
+            ])
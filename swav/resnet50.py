@@ -5,9 +5,14 @@
 # LICENSE file in the root directory of this source tree.
 #
 
+import math
+
 import torch
+import torch.distributed as dist
 import torch.nn as nn
 
+from swav.profiler import timed
+
 
 def conv3x3(in_planes, out_planes, stride=1, groups=1, dilation=1):
     """3x3 convolution with padding"""
@@ -146,6 +151,7 @@ class ResNet(nn.Module):
             output_dim=0,
             hidden_mlp=0,
             nmb_prototypes=0,
+            freeze_prototypes_niters=0,
             eval_mode=False,
     ):
         super(ResNet, self).__init__()
@@ -211,10 +217,8 @@ class ResNet(nn.Module):
 
         # prototype layer
         self.prototypes = None
-        if isinstance(nmb_prototypes, list):
-            self.prototypes = MultiPrototypes(output_dim, nmb_prototypes)
-        elif nmb_prototypes > 0:
-            self.prototypes = nn.Linear(output_dim, nmb_prototypes, bias=False)
+        if isinstance(nmb_prototypes, list) or nmb_prototypes > 0:
+            self.prototypes = Prototypes(output_dim, nmb_prototypes, freeze_niters=freeze_prototypes_niters)
 
         for m in self.modules():
             if isinstance(m, nn.Conv2d):
@@ -314,27 +318,92 @@ class ResNet(nn.Module):
         )[1], 0)
         start_idx = 0
         for end_idx in idx_crops:
-            _out = self.forward_backbone(torch.cat(inputs[start_idx: end_idx]).cuda(non_blocking=True))
+            with timed("h2d"):
+                x = torch.cat(inputs[start_idx: end_idx]).to(self.conv1.weight.device, non_blocking=True)
+            with timed("forward_" + str(inputs[start_idx].shape[-1])):
+                _out = self.forward_backbone(x)
             if start_idx == 0:
                 output = _out
             else:
                 output = torch.cat((output, _out))
             start_idx = end_idx
-        return self.forward_head(output)
-
-
-class MultiPrototypes(nn.Module):
-    def __init__(self, output_dim, nmb_prototypes):
-        super(MultiPrototypes, self).__init__()
-        self.nmb_heads = len(nmb_prototypes)
-        for i, k in enumerate(nmb_prototypes):
-            self.add_module("prototypes" + str(i), nn.Linear(output_dim, k, bias=False))
+        with timed("head"):
+            return self.forward_head(output)
+
+
+class Prototypes(nn.Module):
+    """
+    Prototype layer with the weights of all the heads stored in a single matrix.
+    The scores of every head are computed with one matmul and returned as views
+    of the fused output: a tensor if `nmb_prototypes` is an int, a list otherwise.
+    """
+
+    def __init__(self, output_dim, nmb_prototypes, freeze_niters=0):
+        super(Prototypes, self).__init__()
+        self.multi_head = isinstance(nmb_prototypes, list)
+        self.nmb_prototypes = list(nmb_prototypes) if self.multi_head else [nmb_prototypes]
+        self.nmb_heads = len(self.nmb_prototypes)
+        self.freeze_niters = freeze_niters
+        self.weight = nn.Parameter(torch.empty(sum(self.nmb_prototypes), output_dim))
+        # same initialization as one nn.Linear per head
+        nn.init.kaiming_uniform_(self.weight, a=math.sqrt(5))
+        self._register_load_state_dict_pre_hook(self._load_multi_prototypes)
+
+    def head_weights(self):
+        """views of the weight matrix, one per head"""
+        return self.weight.split(self.nmb_prototypes)
+
+    @torch.no_grad()
+    def normalize(self):
+        """l2-normalize the prototypes in place"""
+        self.weight.div_(self.weight.norm(dim=1, keepdim=True).clamp_min_(1e-12))
+
+    def cancel_gradients(self, iteration):
+        """drop the gradients of the prototypes while they are frozen"""
+        if iteration < self.freeze_niters:
+            self.weight.grad = None
 
     def forward(self, x):
-        out = []
-        for i in range(self.nmb_heads):
-            out.append(getattr(self, "prototypes" + str(i))(x))
-        return out
+        out = nn.functional.linear(x, self.weight)
+        if not self.multi_head:
+            return out
+        return list(out.split(self.nmb_prototypes, dim=1))
+
+    def extra_repr(self):
+        return "output_dim={}, nmb_prototypes={}".format(self.weight.size(1), self.nmb_prototypes)
+
+    def _load_multi_prototypes(self, state_dict, prefix, *args, **kwargs):
+        # checkpoints saved with one nn.Linear per head
+        keys = [prefix + "prototypes" + str(i) + ".weight" for i in range(self.nmb_heads)]
+        if all(k in state_dict for k in keys):
+            state_dict[prefix + "weight"] = torch.cat([state_dict.pop(k) for k in keys])
+
+
+class ShardedPrototypes(Prototypes):
+    """
+    Single-head prototype layer split row-wise across the processes of `group`.
+    Each process holds `nmb_prototypes // world_size` prototypes and scores the
+    embeddings of the global batch against them. It must not be wrapped in
+    DistributedDataParallel since its weights differ on every process.
+    """
+
+    def __init__(self, output_dim, nmb_prototypes, freeze_niters=0, group=None):
+        world_size = dist.get_world_size(group)
+        rank = dist.get_rank(group)
+        assert nmb_prototypes % world_size == 0, "nmb_prototypes should be divisible by the world size"
+        super(ShardedPrototypes, self).__init__(output_dim, nmb_prototypes // world_size, freeze_niters)
+        self.group = group
+        self.nmb_prototypes_total = nmb_prototypes
+
+        # draw the full matrix so that the shards do not start from the same prototypes
+        with torch.no_grad():
+            weight = torch.empty(nmb_prototypes, output_dim)
+            nn.init.kaiming_uniform_(weight, a=math.sqrt(5))
+            self.weight.copy_(weight.chunk(world_size)[rank])
+
+    def extra_repr(self):
+        return "output_dim={}, nmb_prototypes={}, shard={}".format(
+            self.weight.size(1), self.nmb_prototypes_total, self.nmb_prototypes[0])
 
 
 def resnet50(**kwargs):
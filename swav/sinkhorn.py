@@ -0,0 +1,183 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+
+import torch
+import torch.distributed as dist
+
+from swav.profiler import timed
+
+
+def _all_reduce(x, group=None):
+    """all-reduce of the Sinkhorn-Knopp marginals, timed as a region"""
+    with timed("sinkhorn_allreduce"):
+        dist.all_reduce(x, group=group)
+
+
+def distributed_sinkhorn(Q, nmb_iters):
+    """
+    Sinkhorn-Knopp over the scores Q (K x B) of the local batch,
+    the marginals of the prototypes are reduced across all the processes.
+    """
+    with torch.no_grad():
+        sum_Q = torch.sum(Q)
+        _all_reduce(sum_Q)
+        Q /= sum_Q
+
+        u = torch.zeros(Q.shape[0], device=Q.device)
+        r = torch.ones(Q.shape[0], device=Q.device) / Q.shape[0]
+        c = torch.ones(Q.shape[1], device=Q.device) / (dist.get_world_size() * Q.shape[1])
+
+        curr_sum = torch.sum(Q, dim=1)
+        _all_reduce(curr_sum)
+
+        for it in range(nmb_iters):
+            u = curr_sum
+            Q *= (r / u).unsqueeze(1)
+            Q *= (c / torch.sum(Q, dim=0)).unsqueeze(0)
+            curr_sum = torch.sum(Q, dim=1)
+            _all_reduce(curr_sum)
+        return (Q / torch.sum(Q, dim=0, keepdim=True)).t().float()
+
+
+def sharded_sinkhorn(Q, nmb_iters, group=None):
+    """
+    Sinkhorn-Knopp when the prototypes are split across the processes of `group`:
+    Q (K / world_size x B) holds the scores of the local prototypes for the samples
+    of the global batch, so the marginals of the samples are reduced across the shards.
+    """
+    with torch.no_grad():
+        sum_Q = torch.sum(Q)
+        _all_reduce(sum_Q, group=group)
+        Q /= sum_Q
+
+        r = 1. / (dist.get_world_size(group) * Q.shape[0])
+        c = 1. / Q.shape[1]
+
+        for it in range(nmb_iters):
+            Q *= (r / torch.sum(Q, dim=1)).unsqueeze(1)
+            curr_sum = torch.sum(Q, dim=0)
+            _all_reduce(curr_sum, group=group)
+            Q *= (c / curr_sum).unsqueeze(0)
+
+        curr_sum = torch.sum(Q, dim=0)
+        _all_reduce(curr_sum, group=group)
+        return (Q / curr_sum.unsqueeze(0)).t().float()
+
+
+def topk_scores(x, weight, k, chunk_size=4096):
+    """
+    Top-k scores of the rows of x against the prototypes `weight`,
+    the full score matrix is only built for `chunk_size` rows at a time.
+    """
+    values, indices = [], []
+    for x_chunk in x.split(chunk_size):
+        v, i = torch.mm(x_chunk, weight.t()).topk(k, dim=1)
+        values.append(v)
+        indices.append(i)
+    return torch.cat(values), torch.cat(indices)
+
+
+def topk_sinkhorn(Q, indices, nmb_prototypes, nmb_iters):
+    """
+    Sinkhorn-Knopp restricted to the top-k prototypes of every sample of the local batch:
+    Q (B x k) holds the scores of the prototypes `indices` (B x k), all the other entries
+    of the assignment matrix are treated as zeros. Returns the B x k assignments.
+    """
+    with torch.no_grad():
+        sum_Q = torch.sum(Q)
+        _all_reduce(sum_Q)
+        Q /= sum_Q
+
+        r = 1. / nmb_prototypes
+        c = 1. / (dist.get_world_size() * Q.shape[0])
+        indices_flat = indices.reshape(-1)
+
+        for it in range(nmb_iters):
+            curr_sum = torch.zeros(nmb_prototypes, device=Q.device, dtype=Q.dtype)
+            curr_sum.index_add_(0, indices_flat, Q.reshape(-1))
+            _all_reduce(curr_sum)
+            Q *= (r / curr_sum)[indices]
+            Q *= c / torch.sum(Q, dim=1, keepdim=True)
+        return (Q / torch.sum(Q, dim=1, keepdim=True)).float()
+
+
+def topk_assignment_error(dense_q, topk_q, indices):
+    """
+    Average total variation distance between the dense assignments (B x K)
+    and the top-k assignments (B x k) of the prototypes `indices`.
+    """
+    q = torch.zeros_like(dense_q).scatter_(1, indices, topk_q)
+    return 0.5 * torch.mean(torch.sum(torch.abs(dense_q - q), dim=1))
+
+
+class ReducedSyncSinkhorn(object):
+    """
+    Sinkhorn-Knopp with fewer collectives than `distributed_sinkhorn`.
+    The iterations only reduce the marginals of the prototypes within `group`
+    (e.g. the processes of a node, no reduction at all if `group` is None),
+    then the marginals of the prototypes are synchronized once over all the
+    processes and used to rescale the assignments.
+    With `async_sync`, this synchronization runs in the background and its
+    result is used at the next call.
+    """
+
+    def __init__(self, nmb_iters, group=None, async_sync=False):
+        self.nmb_iters = nmb_iters
+        self.group = group
+        self.group_size = 1 if group is None else dist.get_world_size(group)
+        self.async_sync = async_sync
+        self.work = None
+        self.marginals = None
+
+    def _group_all_reduce(self, x):
+        if self.group is not None:
+            _all_reduce(x, group=self.group)
+
+    def _sync_marginals(self, curr_sum):
+        if not self.async_sync:
+            _all_reduce(curr_sum)
+            return curr_sum
+        # use the marginals reduced in the background since the previous call
+        marginals = None
+        if self.work is not None:
+            self.work.wait()
+            marginals = self.marginals
+        self.work = dist.all_reduce(curr_sum, async_op=True)
+        self.marginals = curr_sum
+        return marginals
+
+    def __call__(self, Q):
+        with torch.no_grad():
+            sum_Q = torch.sum(Q)
+            self._group_all_reduce(sum_Q)
+            Q /= sum_Q
+
+            r = 1. / Q.shape[0]
+            c = 1. / (self.group_size * Q.shape[1])
+
+            for it in range(self.nmb_iters):
+                curr_sum = torch.sum(Q, dim=1)
+                self._group_all_reduce(curr_sum)
+                Q *= (r / curr_sum).unsqueeze(1)
+                Q *= (c / torch.sum(Q, dim=0)).unsqueeze(0)
+
+            marginals = self._sync_marginals(torch.sum(Q, dim=1))
+            if marginals is not None:
+                Q *= (marginals.mean() / marginals.clamp_min(1e-12)).unsqueeze(1)
+            return (Q / torch.sum(Q, dim=0, keepdim=True)).t().float()
+
+
+def equipartition_deviation(q):
+    """
+    Total variation distance between the uniform distribution and the marginals
+    of the prototypes in the assignments q (B x K) of all the processes.
+    """
+    with torch.no_grad():
+        marginals = torch.sum(q, dim=0)
+        dist.all_reduce(marginals)
+        marginals /= torch.sum(marginals)
+        return 0.5 * torch.sum(torch.abs(marginals - 1. / marginals.numel()))
@@ -9,12 +9,14 @@ import argparse
 from logging import getLogger
 import pickle
 import os
+import threading
 
 import numpy as np
 import torch
 import torch.nn as nn
 
-from swav.logger import create_logger, PD_Stats
+from swav.logger import create_logger, JSONL_Stats
+from swav.checkpoint import load_checkpoint
 
 import torch.distributed as dist
 
@@ -37,12 +39,20 @@ def bool_flag(s):
         raise argparse.ArgumentTypeError("invalid value for a boolean flag")
 
 
-def init_distributed_mode(args):
+def init_distributed_mode(args, backend=None):
     """
     Initialize the following variables:
         - world_size
         - rank
+        - device
+        - gpu_to_work_on (None on CPU)
+    The processes run on GPU with the nccl backend and on CPU with gloo.
+    The backend is `backend`, or else `args.dist_backend`, nccl if GPUs are
+    available when "auto".
     """
+    backend = backend or getattr(args, "dist_backend", "auto")
+    if backend == "auto":
+        backend = "nccl" if torch.cuda.is_available() else "gloo"
 
     args.is_slurm_job = "SLURM_JOB_ID" in os.environ
 
@@ -59,14 +69,20 @@ def init_distributed_mode(args):
 
     # prepare distributed
     dist.init_process_group(
-        backend="nccl",
+        backend=backend,
         init_method=args.dist_url,
         world_size=args.world_size,
         rank=args.rank,
     )
 
+    if backend == "gloo":
+        args.gpu_to_work_on = None
+        args.device = torch.device("cpu")
+        return
+
     # set cuda device
     args.gpu_to_work_on = args.rank % torch.cuda.device_count()
+    args.device = torch.device("cuda", args.gpu_to_work_on)
     torch.cuda.set_device(args.gpu_to_work_on)
     return
 
@@ -77,7 +93,7 @@ def initialize_exp(params, *args, dump_params=True):
     - dump parameters
     - create checkpoint repo
     - create a logger
-    - create a panda object to keep track of the training statistics
+    - create a stats file to keep track of the training statistics
     """
 
     # dump parameters
@@ -89,9 +105,9 @@ def initialize_exp(params, *args, dump_params=True):
     if not params.rank and not os.path.isdir(params.dump_checkpoints):
         os.mkdir(params.dump_checkpoints)
 
-    # create a panda object to log loss and acc
-    training_stats = PD_Stats(
-        os.path.join(params.dump_path, "stats" + str(params.rank) + ".pkl"), args
+    # create a stats file to log loss and acc
+    training_stats = JSONL_Stats(
+        os.path.join(params.dump_path, "stats" + str(params.rank) + ".jsonl"), args
     )
 
     # create a logger
@@ -107,9 +123,10 @@ def initialize_exp(params, *args, dump_params=True):
     return logger, training_stats
 
 
-def restart_from_checkpoint(ckp_paths, run_variables=None, **kwargs):
+def restart_from_checkpoint(ckp_paths, run_variables=None, read="single", **kwargs):
     """
     Re-start from checkpoint
+    `read` selects the processes reading the file, see `swav.checkpoint.load_checkpoint`
     """
     # look for a checkpoint in exp repository
     if isinstance(ckp_paths, list):
@@ -125,8 +142,10 @@ def restart_from_checkpoint(ckp_paths, run_variables=None, **kwargs):
     logger.info("Found checkpoint at {}".format(ckp_path))
 
     # open checkpoint file
-    checkpoint = torch.load(
-        ckp_path, map_location="cuda:" + str(torch.distributed.get_rank() % torch.cuda.device_count())
+    checkpoint = load_checkpoint(
+        ckp_path,
+        map_location="cuda:" + str(torch.cuda.current_device()) if dist.get_backend() == "nccl" else "cpu",
+        read=read,
     )
 
     # key is what to look for in the checkpoint file
@@ -136,7 +155,7 @@ def restart_from_checkpoint(ckp_paths, run_variables=None, **kwargs):
         if key in checkpoint and value is not None:
             try:
                 msg = value.load_state_dict(checkpoint[key], strict=False)
-                print(msg)
+                logger.info(msg)
             except TypeError:
                 msg = value.load_state_dict(checkpoint[key])
             logger.info("=> loaded {} from checkpoint '{}'".format(key, ckp_path))
@@ -180,6 +199,100 @@ class AverageMeter(object):
         self.avg = self.sum / self.count
 
 
+class DeviceMeter(object):
+    """
+    computes and stores the average and current value of a metric without
+    synchronizing with the device: the running sum stays on the device of the
+    values and is only read back when `val` or `avg` are accessed
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self._val = 0.
+        self._sum = 0.
+        self.count = 0
+
+    def update(self, val, n=1):
+        if torch.is_tensor(val):
+            val = val.detach().float().reshape(())
+        self._val = val
+        self._sum = self._sum + val * n
+        self.count += n
+
+    def all_reduce(self):
+        """average over all the processes, to call on all of them"""
+        device = self._sum.device if torch.is_tensor(self._sum) else \
+            torch.device("cuda" if dist.get_backend() == "nccl" else "cpu")
+        total = torch.stack([
+            torch.as_tensor(self._sum, dtype=torch.float64, device=device),
+            torch.as_tensor(float(self.count), dtype=torch.float64, device=device),
+        ])
+        dist.all_reduce(total)
+        self._sum, self.count = total[0], int(total[1].item())
+        return self
+
+    @property
+    def val(self):
+        return float(self._val)
+
+    @property
+    def sum(self):
+        return float(self._sum)
+
+    @property
+    def avg(self):
+        return self.sum / max(self.count, 1)
+
+
+class BackgroundTask(object):
+    """
+    Run `fn(*args, **kwargs)` in a thread and on its own CUDA stream, which
+    first waits for the work queued on the current stream.
+    `result` waits for the task and makes the current stream wait for its kernels.
+    If the task fails, the process group `abort_group` of its collectives is
+    destroyed, so that the ones the other processes wait for in it fail too
+    instead of hanging, and `result` raises the error on every process.
+    """
+
+    def __init__(self, fn, *args, abort_group=None, **kwargs):
+        self.stream = None
+        self.device = None
+        if torch.cuda.is_available():
+            self.device = torch.cuda.current_device()
+            self.stream = torch.cuda.Stream()
+            self.stream.wait_stream(torch.cuda.current_stream())
+        self.abort_group = abort_group
+        self.output = None
+        self.error = None
+        self.thread = threading.Thread(target=self._run, args=(fn, args, kwargs), daemon=True)
+        self.thread.start()
+
+    def _run(self, fn, args, kwargs):
+        try:
+            if self.stream is None:
+                self.output = fn(*args, **kwargs)
+                return
+            # the current device is per thread
+            torch.cuda.set_device(self.device)
+            with torch.cuda.stream(self.stream):
+                self.output = fn(*args, **kwargs)
+        except Exception as e:
+            logger.error("Background task failed: {}".format(e))
+            self.error = e
+            if self.abort_group is not None:
+                dist.destroy_process_group(self.abort_group)
+
+    def result(self):
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+        if self.stream is not None:
+            torch.cuda.current_stream().wait_stream(self.stream)
+        return self.output
+
+
 def accuracy(output, target, topk=(1,)):
     """Computes the accuracy over the k top predictions for the specified values of k"""
     with torch.no_grad():